@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Measures how fast bulk_IP_add_automated.py pushes addresses, end to end,
+against the stand-in devices of fake_device.py instead of real hardware.
+
+For every device type and batch size, a fresh fake device is started and the
+addresses are pushed with SSG/SRX.run_add_settings_commands, the same way the
+script does it. Reported for each push:
+    commands and addresses per second, from connecting to the last prompt
+    percentiles of the per-command latency, from the device receiving a
+    command to it answering (queueing behind earlier commands included)
+    the bytes sent to and received by the device
+
+The fake devices answer instantly unless told otherwise, so by default the
+figures are the script's own overhead. Give --latency and --commit_latency
+what the real devices take to compare with the figures in the docstring of
+bulk_IP_add_automated.py.
+
+NOTE: written for Python 2.x, NOT 3.x
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import bulk_IP_add_automated as bulk
+import fake_device
+
+def percentile(values, fraction):
+    """
+    Returns the value below which fraction of the sorted values fall
+    (nearest rank), or 0 if there are none.
+    """
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+def make_addresses(count, first="10.0.0.1"):
+    """
+    Returns count consecutive addresses.
+    """
+    start = bulk.ip_to_int(first)
+    return [bulk.int_to_ip(start + i) for i in xrange(count)]
+
+def run_benchmark(device_type, size, args):
+    """
+    Pushes size addresses to a new fake device and returns what it took.
+    """
+    device = fake_device.FakeDevice(device_type, args.latency / 1000.0, args.commit_latency)
+    ip_addrs = make_addresses(size)
+    if device_type == "ssg":
+        batch = bulk.SSG(ip_addrs=ip_addrs, hostname=device.address, ssh_pass="benchmark",
+                         group_limit=args.group_limit, window=args.window, port=device.port,
+                         bulk_load=args.bulk_load)
+    else:
+        batch = bulk.SRX(ip_addrs=ip_addrs, hostname=device.address, ssh_pass="benchmark",
+                         group_limit=args.group_limit, port=device.port,
+                         bulk_load=args.bulk_load, commit_size=args.commit_size)
+    # the script prints every command and answer; keep that out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        started = time.time()
+        trouble = batch.run_add_settings_commands()
+        seconds = time.time() - started
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        bulk.SESSIONS.close()
+        device.close()
+    latencies = sorted(device.latencies)
+    commands = len([x for x in device.commands if x])
+    return {
+        'device_type': device_type,
+        'size': size,
+        'commands': commands,
+        'seconds': seconds,
+        'rate': commands / seconds if seconds else 0.0,
+        'address_rate': size / seconds if seconds else 0.0,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p90': percentile(latencies, 0.90) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'max': percentile(latencies, 1.0) * 1000,
+        'bytes_sent': device.bytes_received,
+        'bytes_received': device.bytes_sent,
+        'trouble': len(trouble),
+        'config_lines': len(device.config),
+    }
+
+def print_results(results):
+    """
+    Prints one line per push.
+    """
+    print ("%-4s %7s %8s %9s %9s %9s %8s %8s %8s %8s %11s %11s %7s"
+           % ("TYPE", "SIZE", "COMMANDS", "SECONDS", "CMDS/S", "ADDRS/S", "P50 MS", "P90 MS",
+              "P99 MS", "MAX MS", "BYTES OUT", "BYTES IN", "TROUBLE"))
+    for result in results:
+        print ("%-4s %7d %8d %9.2f %9.1f %9.1f %8.2f %8.2f %8.2f %8.2f %11d %11d %7d"
+               % (result['device_type'], result['size'], result['commands'],
+                  result['seconds'], result['rate'], result['address_rate'],
+                  result['p50'], result['p90'], result['p99'], result['max'],
+                  result['bytes_sent'], result['bytes_received'], result['trouble']))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks pushing addresses to fake"
+            " SSG and SRX devices on localhost.")
+    parser.add_argument('-t', '--device_type', choices=["ssg", "srx", "both"], default="both",
+            help="The kind of device to push to. Default: both")
+    parser.add_argument('--sizes', metavar='n,n,...', default="10,100,1000,10000,100000",
+            help="The batch sizes (number of addresses) to push."
+                 " Default: 10,100,1000,10000,100000")
+    parser.add_argument('-l', '--latency', metavar='ms', default=0.0, type=float,
+            help="The time every command takes on the fake device, in milliseconds."
+                 " Default: 0")
+    parser.add_argument('--commit_latency', metavar='seconds', default=0.0, type=float,
+            help="The time every commit takes on the fake SRX, in seconds. Default: 0")
+    parser.add_argument('-g', '--group_limit', metavar='group-limit', default=256, type=int,
+            help="The number of addresses per group. Default: 256")
+    parser.add_argument('-w', '--window', metavar='window', default=1, type=int,
+            help="SSG only: the number of commands sent ahead. Default: 1")
+    parser.add_argument('--commit_size', metavar='commit-size', type=int,
+            help="SRX only: commit every this many addresses instead of once at the end.")
+    parser.add_argument('-b', '--bulk_load', action='store_true',
+            help="Push the commands as one file (SFTP on SRX, TFTP on UDP port 69 on SSG).")
+    args = parser.parse_args()
+
+    if args.device_type == "both":
+        device_types = ["ssg", "srx"]
+    else:
+        device_types = [args.device_type]
+    sizes = [int(x) for x in args.sizes.split(",")]
+
+    results = []
+    for device_type in device_types:
+        for size in sizes:
+            print "Pushing " + str(size) + " addresses to a fake " + device_type.upper() + "..."
+            results.append(run_benchmark(device_type, size, args))
+    print
+    print_results(results)
+
+if __name__ == '__main__':
+    main()
@@ -46,23 +46,140 @@ New in Version 3:
 from datetime import date
 import sys
 import argparse
-import subprocess
-import paramiko
 import getpass
 import socket
-import base64
 import time
 import math
+import re
+import struct
+import os
+import collections
+import threading
+import itertools
+import array
+import heapq
+import functools
+import bisect
+import json
+import gzip
+import Queue
+import sqlite3
+import stat
+import signal
+import contextlib
+import importlib
+import shutil
+import hashlib
 
 __version__ = "3.0"
 __authors__ = "Brandon Silver and Joseph Malone, Summer Internship 2014"
 __date__ = "08/14/2014"
 
+class LazyModule(object):
+    """
+    Stands in for a module that is only imported the first time one of its
+    attributes is used, so that runs that never connect to a device (e.g.
+    --compile and --find) don't pay for importing it.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+# the SSH library, only needed once a device is connected to
+paramiko = LazyModule("paramiko")
+
+# Junos prompts look like "user@host> " (operational mode) or "user@host# "
+# (configuration mode) at the start of a line. The device prints one when it
+# is ready for the next command.
+JUNOS_PROMPT = re.compile(r'^[\w.\-]+@[\w.\-]+[>#] ?', re.M)
+# lines Junos prints when a command or a commit didn't go through
+JUNOS_ERROR = re.compile(r'^\s*(error:.*|syntax error.*|unknown command.*|'
+                         r'missing argument.*|.*is ambiguous.*|'
+                         r'load complete \(\d+ errors?\).*)$', re.M)
+# ScreenOS prompts look like "hostname-> " or "hostname(M)-> "
+SCREENOS_PROMPT = re.compile(r'^[\w.\-()/:]+-> ?', re.M)
+# lines ScreenOS prints when a command didn't take: a caret under the
+# offending word, "unknown keyword", or a failed line of a merged file.
+# Matched against the output only, never the echoed command (see
+# screenos_errors), which may hold any word in a description or name.
+SCREENOS_ERROR = re.compile(r'^\s*(\^-+.*|unknown keyword.*|[Ff]ailed command.*)$', re.M)
+# what the devices print when they pause long output for a keypress
+JUNOS_PAGER = re.compile(r'---\(more[^)]*\)---')
+SCREENOS_PAGER = re.compile(r' *--- more --- *')
+
+# the kinds of device the script can drive, by the name used with -t and in
+# inventories (see register_driver)
+DRIVERS = collections.OrderedDict()
+
+def register_driver(cls):
+    """
+    Adds a BatchGroup subclass to DRIVERS under its device_type. Use it as a
+    class decorator, e.g. in a module loaded with --driver.
+    """
+    DRIVERS[cls.device_type] = cls
+    return cls
+
 class BatchGroup(object):
     """
     The information common to SSG and SRX systems that is needed to perform a
     batch run. Subclass for specific devices/platforms.
+
+    A driver (a subclass registered with register_driver) provides:
+        device_type, prompt, pager, newline, error
+                        the class attributes below
+        __init__        sets ip_addrs, netmask, addr_description,
+                        addr_group_prefix, zone, group_limit, port and
+                        get_config_command, and calls BatchGroup.__init__
+                        with the add and remove commands
+        run_commands    runs a list of commands on the device
+        config_entries  reads the address book out of configuration lines
+        packed_set_commands, add_member_command, remove_member_command,
+        remove_group_commands, remove_address_command
+                        generate the commands of sync, packing and planned
+                        removals
+    from_args works as is for a constructor taking the keyword arguments SSG
+    and SRX take (ip_addrs, netmask, ..., ssh_user, port).
     """
+    # the name used with -t and in inventories
+    device_type = None
+    # what the device prints when it's ready for the next command, when it
+    # pauses long output, and when a command didn't take (regular expressions)
+    prompt = None
+    pager = None
+    error = None
+    # what ends a command line
+    newline = "\n"
+    # with sync, also remove addresses that are in this batch's groups on the
+    # device but no longer in the batch
+    remove_stale = False
+    # work out sync and removals from the state store (see StateStore) instead
+    # of the device's configuration and the input file
+    use_state = False
+    # put new addresses into any group of this action with room, not only
+    # this batch's own (see packed_groups)
+    pack_groups = False
+    # after removals, empty the groups of this action that are at most this
+    # full into the others (see plan_compaction); None not to
+    compact = None
+    # the commands only depend on the kind of device and the CLI arguments,
+    # not on which device it is (see compile_batches)
+    same_commands_per_type = True
+    # where to keep the journals that let interrupted pushes resume (see
+    # PushJournal); None not to
+    journal_dir = None
+    # how many seconds the addresses added stay before they expire (see
+    # ExpiryScheduler); None for good
+    ttl = None
+
+    # a command whose output changes whenever the configuration does (see
+    # config_marker); None if there is none
+    config_marker_command = None
+
     def __init__(self, add_settings_commands, remove_settings_commands,
             hostname, ssh_user, ssh_pass):
         self.add_settings_commands = add_settings_commands
@@ -72,425 +189,3630 @@ class BatchGroup(object):
         self.ssh_pass = ssh_pass
 
     def __str__(self):
-        return "\n".join(x for x in (self.add_settings_commands + self.remove_settings_commands))
+        return "\n".join(itertools.chain(self.add_settings_commands,
+                                         self.remove_settings_commands))
 
     def print_add_settings_commands(self):
         """
         Prints out the commands to add the settings to the device.
         """
-        for command in self.add_settings_commands:
-            print command
+        for command in self.add_settings_commands:
+            print command
+
+    def print_remove_settings_commands(self):
+        """
+        Prints out the commands to remove the settings from the device.
+        """
+        for command in self.remove_settings_commands:
+            print command
+
+    @classmethod
+    def from_args(cls, ip_addresses, args, hostname, user):
+        """
+        Returns the batch for one device, set up from the CLI arguments that
+        aren't specific to a kind of device.
+        """
+        return cls(ip_addrs=ip_addresses, netmask=args.netmask,
+                   addr_description=args.description,
+                   addr_group_prefix=args.action_description, zone=args.zone,
+                   group_limit=int(args.group_limit), hostname=hostname,
+                   ssh_user=user, port=int(args.port))
+
+    def run_add_settings_commands(self):
+        """
+        Runs the commands to add the settings to the device.
+        """
+        return self.run_commands(self.add_settings_commands)
+
+    def run_remove_settings_commands(self):
+        """
+        Runs the commands to remove the settings from the device.
+        """
+        return self.run_commands(self.remove_settings_commands)
+
+    def run_commands(self, commands):
+        """
+        Runs a list of commands on the device. Returns a list of (command,
+        problem) tuples, empty if everything went fine.
+        """
+        raise NotImplementedError(self.device_type + " doesn't define run_commands")
+
+    def config_entries(self, lines):
+        """
+        Yields the address book entries in the device's configuration lines
+        as (kind, zone, name, value) tuples (see ssg_config_entries).
+        """
+        raise NotImplementedError(self.device_type + " doesn't define config_entries")
+
+    def packed_set_commands(self, entries, occupancy):
+        """
+        Returns the commands adding entries to the groups of this action,
+        topping up those in occupancy (member counts by group name) first.
+        """
+        raise NotImplementedError(self.device_type + " doesn't define packed_set_commands")
+
+    def add_member_command(self, group, name):
+        raise NotImplementedError(self.device_type + " doesn't define add_member_command")
+
+    def remove_member_command(self, group, name):
+        raise NotImplementedError(self.device_type + " doesn't define remove_member_command")
+
+    def remove_group_commands(self, group, members):
+        """
+        Returns the commands removing group, which holds members.
+        """
+        raise NotImplementedError(self.device_type + " doesn't define remove_group_commands")
+
+    def remove_address_command(self, name):
+        raise NotImplementedError(self.device_type + " doesn't define remove_address_command")
+
+    def journal(self, commands):
+        """
+        Returns the PushJournal for running commands on the device, or None
+        without journal_dir.
+        """
+        if self.journal_dir is None:
+            return None
+        return PushJournal(self.journal_dir, self.hostname, commands)
+
+    def get_config(self):
+        """
+        Returns the address book part of the device's running configuration.
+        """
+        METRICS.describe(self.hostname, self.device_type)
+        return run_show_command(self.get_config_command, self.hostname, self.ssh_user,
+                self.ssh_pass, self.prompt, self.pager, self.newline, port=self.port)
+
+    def is_batch_group(self, group):
+        """
+        Returns True if group is the name of one of the address groups this
+        batch puts its addresses in.
+        """
+        base = self.addr_group_prefix + "_" + self.addr_description
+        return group == base or (group.startswith(base + "_") and
+                                 group[len(base)+1:].isdigit())
+
+    def is_action_group(self, group):
+        """
+        Returns True if group is one of the groups of this batch's action
+        (addr_group_prefix), whichever batch made it. Packing and compacting
+        treat these as interchangeable, so they should all be used by the
+        same policies.
+        """
+        return group.startswith(self.addr_group_prefix + "_")
+
+    def owns_group(self, group):
+        """
+        Returns True if this batch's addresses may be in group: one of its own
+        groups, or with pack_groups any group of its action.
+        """
+        if self.pack_groups:
+            return self.is_action_group(group)
+        return self.is_batch_group(group)
+
+    def live_index(self):
+        """
+        Returns what's on the device as a ConfigIndex: from the state store if
+        use_state is set and it knows the device, otherwise from the device's
+        configuration.
+        """
+        if self.use_state and STATE.knows(self.hostname):
+            return ConfigIndex(STATE.entries(self.hostname, self.zone))
+        return self.config_index()
+
+    def config_index(self):
+        """
+        Returns the address book in the device's configuration as a
+        ConfigIndex. With the snapshot cache open (see ConfigCache), the
+        configuration is only downloaded if the device's config marker says
+        it changed since the cached copy was taken.
+        """
+        if not CACHE.is_open():
+            return ConfigIndex(self.config_entries(self.get_config().splitlines()))
+        # before the download, so a change in between makes the copy stale
+        # rather than the marker
+        marker = self.config_marker()
+        entries = CACHE.entries(self.hostname, self.zone, marker)
+        if entries is None:
+            entries = list(self.config_entries(self.get_config().splitlines()))
+            CACHE.store(self.hostname, self.zone, marker, entries)
+        return ConfigIndex(entries)
+
+    def config_marker(self):
+        """
+        Returns something that's cheap to get from the device and changes
+        whenever its configuration does (config_marker_command's output), or
+        None if the device doesn't give one.
+        """
+        if self.config_marker_command is None:
+            return None
+        output = run_show_command(self.config_marker_command, self.hostname, self.ssh_user,
+                self.ssh_pass, self.prompt, self.pager, self.newline, port=self.port)
+        if not output.strip() or self.error.search(output):
+            return None
+        return " ".join(output.split())
+
+    def action_groups(self, live):
+        """
+        Returns the members of every group of this batch's action on the
+        device, by group name.
+        """
+        return dict((group, members) for (zone, group), members in live.groups.iteritems()
+                    if zone == self.zone and self.is_action_group(group))
+
+    def packed_add_commands(self, live):
+        """
+        Returns the commands adding this batch's addresses to the device,
+        topping up the groups of its action that have room before opening new
+        ones. Addresses already in one of those groups are left out.
+        """
+        groups = self.action_groups(live)
+        grouped = set()
+        for members in groups.itervalues():
+            grouped.update(members)
+        entries = [entry for entry in self.ip_addrs
+                   if address_parts(entry, self.netmask)[0] not in grouped]
+        occupancy = dict((group, len(members)) for group, members in groups.iteritems())
+        return self.packed_set_commands(entries, occupancy)
+
+    def sync_commands(self, live, remove_stale=False):
+        """
+        Returns the commands needed to bring the device in line with this
+        batch, given what's on it as a ConfigIndex (of its configuration, or
+        of the state store).
+
+        Addresses that already exist on the device are not set again, and
+        addresses already in one of this batch's groups are not added to a
+        group again. With remove_stale, addresses in this batch's groups that
+        are no longer in the batch are taken out of the groups and deleted,
+        unless another group still uses them.
+        """
+        # every address that is in one of this batch's groups on the device
+        grouped = set()
+        for (zone, group), members in live.groups.iteritems():
+            if zone == self.zone and self.owns_group(group):
+                grouped.update(members)
+
+        commands = []
+        wanted = set()
+        # the groups that will get new members
+        filled = set()
+        for command in self.add_settings_commands:
+            for kind, zone, name, value in self.config_entries([command]):
+                if kind == "address":
+                    wanted.add(name)
+                    needed = (zone, name) not in live.addresses
+                elif kind == "member":
+                    needed = value not in grouped
+                    if needed:
+                        filled.add(name)
+                else:
+                    needed = (zone, name) not in live.groups
+                if needed:
+                    commands.append(command)
+                    break
+        if not remove_stale:
+            return commands
+        return commands + self.removal_commands(live, lambda members: members - wanted,
+                                                filled)
+
+    def removal_commands(self, live, gone_from, filled=(), addresses=(), owned=None):
+        """
+        Returns the commands taking addresses out of this batch's groups (or
+        the groups owned(group) is True for) on the device (live, a
+        ConfigIndex) and deleting them. gone_from(members) returns which
+        members of a group to take out. A group losing all its members is
+        removed as a whole, in one or two commands whatever its size, unless
+        it's in filled; only groups keeping some members have them taken out
+        one by one. The addresses taken out, and any in addresses that are on
+        the device, are deleted unless some other group still uses them, so
+        removing a batch costs about one command per address.
+        """
+        if owned is None:
+            owned = self.is_batch_group
+        member_removals = []
+        group_removals = []
+        gone_addresses = set(x for x in addresses if (self.zone, x) in live.addresses)
+        for (zone, group), members in sorted(live.groups.iteritems()):
+            if zone != self.zone or not owned(group):
+                continue
+            gone = gone_from(members)
+            gone_addresses.update(gone)
+            # a group left empty is removed as a whole
+            if gone == members and group not in filled:
+                group_removals.extend(self.remove_group_commands(group, sorted(members)))
+            else:
+                member_removals.extend(self.remove_members_commands(group, sorted(gone)))
+        # other groups that still use an address keep it alive
+        for (zone, group), members in live.groups.iteritems():
+            if zone == self.zone and not owned(group):
+                gone_addresses -= members
+        address_removals = [self.remove_address_command(name)
+                            for name in sorted(gone_addresses)]
+        return member_removals + group_removals + address_removals
+
+    def record_expiry(self, names):
+        """
+        Records in the state store that the addresses names, those of them
+        the device took, expire ttl seconds from now, or that they don't
+        expire any more without ttl. Returns when they expire, or None.
+        """
+        if self.ttl is None:
+            STATE.forget_expiries(self.hostname, self.zone, names)
+            return None
+        expires = time.time() + self.ttl
+        STATE.set_expiry(self.hostname, self.zone, names, expires)
+        return expires
+
+    def expiry_commands(self, names):
+        """
+        Returns the commands removing the expired addresses names from the
+        device, out of whichever of this action's groups they're in, worked
+        out from what's on it (see live_index), and the names that aren't on
+        it any more.
+        """
+        live = self.live_index()
+        names = set(names)
+        gone = set(name for name in names if (self.zone, name) not in live.addresses)
+        commands = self.removal_commands(live, lambda members: members & names,
+                                         addresses=names, owned=self.is_action_group)
+        return commands, gone
+
+    def add_members_commands(self, group, names):
+        """
+        Returns the commands putting names in group.
+        """
+        return [self.add_member_command(group, name) for name in names]
+
+    def remove_members_commands(self, group, names):
+        """
+        Returns the commands taking names out of group.
+        """
+        return [self.remove_member_command(group, name) for name in names]
+
+    def address_names(self):
+        """
+        Returns the names of the address objects of this batch.
+        """
+        return set(address_parts(entry, self.netmask)[0] for entry in self.ip_addrs)
+
+    def planned_remove_commands(self):
+        """
+        Returns the commands to remove this batch's addresses from the device,
+        worked out from what's on it (see live_index), in whichever of its
+        groups (see owns_group) they ended up, rather than from the input file
+        and group_limit. With compact, sparse groups are then emptied into
+        the others.
+        """
+        names = self.address_names()
+        live = self.live_index()
+        commands = self.removal_commands(live, lambda members: members & names,
+                                         addresses=names, owned=self.owns_group)
+        if self.compact is not None:
+            groups = dict((group, members - names)
+                          for group, members in self.action_groups(live).iteritems())
+            # the groups the removal leaves empty are gone already
+            groups = dict((group, members) for group, members in groups.iteritems()
+                          if members)
+            commands += self.compaction_commands(groups)
+        return commands
+
+    def compaction_commands(self, groups):
+        """
+        Returns the commands emptying the sparse groups among groups (members
+        by group name) into the others: every moved address is added to its
+        new group before the old group is removed, so it's never unblocked.
+        """
+        moves, emptied = plan_compaction(groups, self.group_limit, self.compact)
+        targets = collections.OrderedDict()
+        for name, source, target in moves:
+            targets.setdefault(target, []).append(name)
+        commands = []
+        for target, names in targets.iteritems():
+            commands.extend(self.add_members_commands(target, names))
+        for group in emptied:
+            commands.extend(self.remove_group_commands(group, sorted(groups[group])))
+        return commands
+
+    def run_sync_settings_commands(self):
+        """
+        Fetches the device's configuration and runs only the commands needed to
+        bring it in line with this batch (see sync_commands).
+        """
+        live = self.live_index()
+        if self.pack_groups:
+            self.add_settings_commands = self.packed_add_commands(live)
+        commands = self.sync_commands(live, self.remove_stale)
+        OUTPUT.write(self.hostname + ": " + str(len(commands)) + " commands needed to sync\n" +
+                     "".join(command + "\n" for command in commands))
+        if not commands:
+            return []
+        return self.run_commands(commands)
+
+class ConfigIndex(object):
+    """
+    The address book of a device configuration, indexed so that checking for
+    an address or a group membership is a dict lookup: addresses by
+    (zone, name), and the set of member names of each group by (zone, group).
+
+    Built from the (kind, zone, name, value) entries of ssg_config_entries or
+    srx_config_entries.
+    """
+    def __init__(self, entries=()):
+        self.addresses = {}
+        self.groups = {}
+        for kind, zone, name, value in entries:
+            if kind == "address":
+                self.addresses[(zone, name)] = value
+            elif kind == "group":
+                self.groups.setdefault((zone, name), set())
+            elif kind == "member":
+                self.groups.setdefault((zone, name), set()).add(value)
+
+class ChannelReader(object):
+    """
+    Reads the output of a shell channel one prompt at a time, so that the next
+    command can be sent as soon as the device is ready for it instead of after
+    a fixed sleep.
+
+    What's read is appended to a bytearray in reads of up to read_size bytes,
+    and only the lines that arrived since the last look are searched for the
+    prompt, so long output (a big "get config", a slow commit) costs time in
+    proportion to its length rather than its square.
+    """
+    # the most to ask the channel for in one read
+    read_size = 32768
+
+    def __init__(self, channel, prompt, pager=None, read_size=None):
+        self.channel = channel
+        self.prompt = prompt
+        # when the device pauses its output with this, a space gets it going
+        self.pager = pager
+        if read_size is not None:
+            self.read_size = read_size
+        # whatever has been read but not handed out yet
+        self.buffer = bytearray()
+        # where the first line not searched to its end yet starts; prompts
+        # are at the start of a line, so no match can start before it
+        self.searched = 0
+        # what went over the channel, for the metrics
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def send(self, text):
+        """
+        Sends all of text to the device.
+        """
+        self.channel.sendall(text)
+        self.bytes_sent += len(text)
+
+    def read_until_prompt(self, timeout):
+        """
+        Returns everything the device printed up to and including its next
+        prompt. Raises socket.timeout if no prompt shows up within timeout
+        seconds; whatever was read up to then stays in self.buffer.
+        """
+        deadline = time.time() + timeout
+        while True:
+            match = self.prompt.search(self.buffer, self.searched)
+            if match:
+                end = match.end()
+                output = memoryview(self.buffer)[:end].tobytes()
+                del self.buffer[:end]
+                self.searched = 0
+                return output
+            self.searched = self.buffer.rfind("\n") + 1
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("no prompt after %s seconds" % timeout)
+            self.channel.settimeout(remaining)
+            try:
+                coutstring = self.channel.recv(self.read_size)
+            except socket.timeout:
+                continue
+            if not coutstring:
+                raise EOFError("the device closed the session")
+            self.bytes_received += len(coutstring)
+            if self.pager is not None:
+                # the device erases the pager prompt with backspaces; without
+                # them, a prompt right after the last page starts a line
+                coutstring = coutstring.replace("\x08", "")
+            self.buffer.extend(coutstring)
+            if self.pager is not None:
+                more = self.pager.search(self.buffer, self.searched)
+                if more:
+                    del self.buffer[more.start():more.end()]
+                    self.send(" ")
+
+    def pending(self):
+        """
+        Returns what has been read but not handed out yet.
+        """
+        return str(self.buffer)
+
+    def report(self, hostname):
+        """
+        Adds the bytes sent and received so far to the metrics of the device.
+        """
+        METRICS.count('bytes_sent', hostname, self.bytes_sent)
+        METRICS.count('bytes_received', hostname, self.bytes_received)
+        self.bytes_sent = self.bytes_received = 0
+
+# upper bounds of the buckets of the timing histograms, in seconds
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                  30, 60, 120, 300, 600)
+# what every metric measures, for the exports
+METRIC_HELP = collections.OrderedDict([
+    ('connect_seconds', "Time to open the connection and set up SSH."),
+    ('auth_seconds', "Time to log in."),
+    ('command_seconds', "Time from sending a command to the prompt after it."),
+    ('commit_seconds', "Time from sending a commit to the prompt after it (SRX)."),
+    ('teardown_seconds', "Time to close a shell or a connection."),
+    ('commands', "Commands sent."),
+    ('command_errors', "Commands the device answered with an error."),
+    ('timeouts', "Connections and commands that timed out."),
+    ('bytes_sent', "Bytes sent to the device."),
+    ('bytes_received', "Bytes received from the device."),
+])
+
+class Histogram(object):
+    """
+    Counts of timings by bucket (see METRIC_BUCKETS), with their sum and
+    maximum.
+    """
+    def __init__(self):
+        # the last one is for anything above the last bucket
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding the given fraction of
+        the timings (the maximum for the last bucket), or 0 if there are none.
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(METRIC_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self):
+        """
+        Returns (upper bound, timings up to it) pairs, Prometheus style.
+        """
+        bounds = [str(x) for x in METRIC_BUCKETS] + ["+Inf"]
+        pairs = []
+        total = 0
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+class Metrics(object):
+    """
+    Timings and counts of everything sent to the devices in this run, kept
+    per device, to see where the time goes on each device model. Names are
+    the keys of METRIC_HELP: the ones ending in _seconds are histograms, the
+    others counters. Safe to use from several threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, hostname) -> Histogram
+        self.histograms = {}
+        # (name, hostname) -> number
+        self.counters = {}
+        # hostname -> "ssg" or "srx"
+        self.device_types = {}
+
+    def describe(self, hostname, device_type):
+        """
+        Records what kind of device hostname is, for the device_type label.
+        """
+        self.device_types[hostname] = device_type
+
+    def observe(self, name, hostname, seconds):
+        with self.lock:
+            histogram = self.histograms.get((name, hostname))
+            if histogram is None:
+                histogram = self.histograms[(name, hostname)] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, hostname, amount=1):
+        with self.lock:
+            self.counters[(name, hostname)] = self.counters.get((name, hostname), 0) + amount
+
+    def to_dict(self):
+        """
+        Returns the metrics by device, with the percentiles of every histogram
+        worked out (to the upper bound of their bucket).
+        """
+        devices = {}
+        with self.lock:
+            for (name, hostname), histogram in self.histograms.iteritems():
+                device = devices.setdefault(hostname, {'histograms': {}, 'counters': {}})
+                device['histograms'][name] = {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'max': histogram.max,
+                    'mean': histogram.sum / histogram.count,
+                    'p50': histogram.percentile(0.5),
+                    'p90': histogram.percentile(0.9),
+                    'p99': histogram.percentile(0.99),
+                    'buckets': collections.OrderedDict(histogram.cumulative()),
+                }
+            for (name, hostname), value in self.counters.iteritems():
+                device = devices.setdefault(hostname, {'histograms': {}, 'counters': {}})
+                device['counters'][name] = value
+        for hostname, device in devices.iteritems():
+            device['device_type'] = self.device_types.get(hostname, "")
+        return devices
+
+    def write_json(self, path):
+        with open(path, "w") as output:
+            json.dump({'generated': time.time(), 'devices': self.to_dict()}, output,
+                      indent=2, sort_keys=True)
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics in the Prometheus text format, for the textfile
+        collector of the node exporter or a pushgateway.
+        """
+        def labels(hostname, extra=""):
+            device_type = self.device_types.get(hostname, "")
+            return ('{device="' + prometheus_escape(hostname) + '",device_type="' +
+                    prometheus_escape(device_type) + '"' + extra + '}')
+
+        lines = []
+        with self.lock:
+            for name, description in METRIC_HELP.iteritems():
+                if name.endswith("_seconds"):
+                    found = sorted((hostname, histogram) for (key, hostname), histogram
+                                   in self.histograms.iteritems() if key == name)
+                    if not found:
+                        continue
+                    metric = "bulk_ip_add_" + name
+                    lines.append("# HELP " + metric + " " + description)
+                    lines.append("# TYPE " + metric + " histogram")
+                    for hostname, histogram in found:
+                        for bound, count in histogram.cumulative():
+                            lines.append("%s_bucket%s %d" % (metric,
+                                         labels(hostname, ',le="' + bound + '"'), count))
+                        lines.append("%s_sum%s %r" % (metric, labels(hostname), histogram.sum))
+                        lines.append("%s_count%s %d" % (metric, labels(hostname),
+                                                         histogram.count))
+                else:
+                    found = sorted((hostname, value) for (key, hostname), value
+                                   in self.counters.iteritems() if key == name)
+                    if not found:
+                        continue
+                    metric = "bulk_ip_add_" + name + "_total"
+                    lines.append("# HELP " + metric + " " + description)
+                    lines.append("# TYPE " + metric + " counter")
+                    for hostname, value in found:
+                        lines.append("%s%s %d" % (metric, labels(hostname), value))
+        with open(path, "w") as output:
+            output.write("\n".join(lines) + "\n")
+
+# the metrics of everything in this run
+METRICS = Metrics()
+
+def prometheus_escape(value):
+    """
+    Escapes a label value for the Prometheus text format.
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class OutputWriter(object):
+    """
+    Writes what the devices print to the terminal, and to a gzip-compressed
+    session log once open_log() is called, from a thread of its own: the
+    push loops only queue the text, so a slow terminal (or a slow disk) never
+    holds up sending the next command.
+    """
+    def __init__(self, echo=True):
+        # whether to print to the terminal at all
+        self.echo = echo
+        self.log = None
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def open_log(self, path):
+        """
+        Starts appending everything written to the gzip file at path.
+        """
+        self.flush()
+        self.log = gzip.open(path, "ab")
+
+    def write(self, text):
+        """
+        Queues text to be written; returns right away.
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put(text)
+
+    def run(self):
+        while True:
+            text = self.queue.get()
+            try:
+                # a sink that fails (a closed pipe, a full disk) is given up
+                # on, and the queue keeps draining so flush() still returns
+                if self.echo:
+                    try:
+                        sys.stdout.write(text)
+                    except Exception as e:
+                        self.echo = False
+                        self.report("the terminal", e)
+                if self.log is not None:
+                    try:
+                        self.log.write(text)
+                    except Exception as e:
+                        self.log = None
+                        self.report("the session log", e)
+            finally:
+                self.queue.task_done()
+
+    def report(self, sink, error):
+        """
+        Says on standard error that nothing more is written to sink.
+        """
+        try:
+            sys.stderr.write("Stopped writing to " + sink + ": " + str(error) + "\n")
+        except Exception:
+            pass
+
+    def flush(self):
+        """
+        Waits until everything queued so far has been written.
+        """
+        self.queue.join()
+        if self.echo:
+            try:
+                sys.stdout.flush()
+            except Exception as e:
+                self.echo = False
+                self.report("the terminal", e)
+
+    def close(self):
+        """
+        Writes out what's queued and closes the session log.
+        """
+        self.flush()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+# everything the devices print goes through here
+OUTPUT = OutputWriter()
+
+class SessionManager(object):
+    """
+    Keeps one authenticated SSH connection per device and user open, so that
+    the add, verify and remove phases of a run (or many small batches in a
+    row) pay for the connection and authentication only once. Channels are
+    opened on the shared connection on demand, and a connection that has
+    dropped is made again the next time it's needed. slot picks one of
+    several connections to the same device, for pushes that use more than
+    one at once (see run_via_ssh_ssg_parallel).
+
+    WARNING: like the rest of this script, does NOT verify the authenticity
+    of the device.
+    """
+    def __init__(self, keepalive=30, timeout=30):
+        # seconds between keepalive packets on idle connections
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.transports = {}
+        # one lock per connection, so that connecting to one device doesn't
+        # hold up the others
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def transport(self, hostname, user, password, port=22, slot=0):
+        """
+        Returns an authenticated transport to the device, connecting (again)
+        if there isn't a live one.
+        """
+        key = (hostname, port, user, slot)
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            tport = self.transports.get(key)
+            if tport is not None and tport.is_active() and tport.is_authenticated():
+                return tport
+            if tport is not None:
+                tport.close()
+            started = time.time()
+            try:
+                sock = socket.create_connection((hostname, port), self.timeout)
+            except socket.timeout:
+                METRICS.count('timeouts', hostname)
+                raise
+            tport = paramiko.Transport(sock)
+            try:
+                tport.start_client(timeout=self.timeout)
+                connected = time.time()
+                METRICS.observe('connect_seconds', hostname, connected - started)
+                tport.auth_password(user, password)
+                METRICS.observe('auth_seconds', hostname, time.time() - connected)
+            except Exception:
+                tport.close()
+                raise
+            tport.set_keepalive(self.keepalive)
+            self.transports[key] = tport
+            return tport
+
+    def open_session(self, hostname, user, password, port=22, slot=0):
+        """
+        Returns a new session channel on the device's connection. If the
+        connection turns out to be dead, it's made again once.
+        """
+        try:
+            return self.transport(hostname, user, password, port, slot).open_session()
+        except (paramiko.SSHException, EOFError, socket.error):
+            self.drop(hostname, user, port, slot)
+            return self.transport(hostname, user, password, port, slot).open_session()
+
+    def open_shell(self, hostname, user, password, port=22, width=512, slot=0):
+        """
+        Returns an interactive shell channel on the device. The terminal is
+        wide so that the device doesn't wrap long echoed commands.
+        """
+        channel = self.open_session(hostname, user, password, port, slot)
+        channel.set_combine_stderr(True)
+        channel.get_pty(width=width)
+        channel.invoke_shell()
+        return channel
+
+    def open_exec(self, hostname, user, password, command, port=22):
+        """
+        Returns a channel running a single command on the device.
+        """
+        channel = self.open_session(hostname, user, password, port)
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        return channel
+
+    def open_sftp(self, hostname, user, password, port=22):
+        """
+        Returns an SFTP client on the device's connection.
+        """
+        try:
+            return paramiko.SFTPClient.from_transport(
+                self.transport(hostname, user, password, port))
+        except (paramiko.SSHException, EOFError, socket.error):
+            self.drop(hostname, user, port)
+            return paramiko.SFTPClient.from_transport(
+                self.transport(hostname, user, password, port))
+
+    def drop(self, hostname, user, port=22, slot=0):
+        """
+        Closes and forgets the connection to one device.
+        """
+        tport = self.transports.pop((hostname, port, user, slot), None)
+        if tport is not None:
+            started = time.time()
+            tport.close()
+            METRICS.observe('teardown_seconds', hostname, time.time() - started)
+
+    def close(self):
+        """
+        Closes every connection.
+        """
+        for hostname, port, user, slot in list(self.transports):
+            self.drop(hostname, user, port, slot)
+
+# the connections shared by everything in this run
+SESSIONS = SessionManager()
+
+def run_show_command(command, hostname, user, password, prompt, pager=None, newline="\n",
+        timeout=300, port=22):
+    """
+    Runs one operational command (e.g. "get config") on a device and returns
+    its output, without the echoed command and the prompt that follows it.
+    """
+    channel = SESSIONS.open_shell(hostname, user, password, port)
+    reader = ChannelReader(channel, prompt, pager)
+    try:
+        reader.read_until_prompt(30)
+        started = time.time()
+        reader.send(command + newline)
+        output = reader.read_until_prompt(timeout)
+        METRICS.observe('command_seconds', hostname, time.time() - started)
+        METRICS.count('commands', hostname)
+    except socket.timeout:
+        METRICS.count('timeouts', hostname)
+        raise
+    finally:
+        channel.close()
+        reader.report(hostname)
+    # what's left of the pager prompts after the device erases them
+    output = output.replace("\x08", "")
+    return "\n".join(output.splitlines()[1:-1])
+
+def ip_to_int(ip):
+    """
+    Returns the dotted quad ip as a 32-bit integer.
+    """
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+def int_to_ip(number):
+    """
+    Returns the 32-bit integer number as a dotted quad.
+    """
+    return socket.inet_ntoa(struct.pack("!I", number))
+
+def length_to_netmask(length):
+    """
+    Returns the dotted netmask for a prefix length, e.g. 255.255.255.0 for 24.
+    """
+    return int_to_ip((0xffffffff << (32 - length)) & 0xffffffff)
+
+def netmask_to_length(netmask):
+    """
+    Returns the prefix length for a dotted netmask, e.g. 24 for 255.255.255.0.
+    """
+    return bin(ip_to_int(netmask)).count("1")
+
+def address_parts(entry, netmask):
+    """
+    Splits an input entry, either a bare address ("1.2.3.4") or a prefix
+    ("1.2.3.0/24"), into the name of its address object, the address, the
+    dotted netmask and the prefix length. Bare addresses get netmask.
+    """
+    entry = entry.strip()
+    if "/" in entry:
+        ip, length = entry.split("/", 1)
+        length = int(length)
+        return entry, ip, length_to_netmask(length), length
+    return entry, entry, netmask, netmask_to_length(netmask)
+
+def aggregate_addresses(ip_addrs, netmask="255.255.255.255", max_overcoverage=0.0,
+        min_length=16):
+    """
+    Returns the smallest list of prefixes that covers exactly the addresses
+    and prefixes in ip_addrs, sorted. Prefixes as long as netmask are
+    returned as bare addresses, others as "network/length".
+
+    With max_overcoverage above 0, neighbouring prefixes are also merged into
+    a shorter one (no shorter than min_length) as long as no more than that
+    fraction of the addresses it covers were not in ip_addrs, e.g. 0.1 lets a
+    /24 stand in for 231 or more of its addresses.
+    """
+    default_length = netmask_to_length(netmask)
+    # every entry as a range of addresses
+    ranges = []
+    for entry in ip_addrs:
+        name, ip, mask, length = address_parts(entry, netmask)
+        if not ip:
+            continue
+        start = ip_to_int(ip) & ip_to_int(length_to_netmask(length))
+        ranges.append((start, start + (1 << (32 - length)) - 1))
+    ranges.sort()
+
+    # merge overlapping and adjacent ranges, then cut each merged range into
+    # the fewest aligned prefixes
+    prefixes = []
+    merged_start, merged_end = None, None
+    for start, end in ranges + [(None, None)]:
+        if merged_end is not None and start is not None and start <= merged_end + 1:
+            merged_end = max(merged_end, end)
+            continue
+        if merged_start is not None:
+            current = merged_start
+            while current <= merged_end:
+                length = 32
+                # the shortest prefix that starts at current and still fits
+                while length > 0:
+                    size = 1 << (32 - (length - 1))
+                    if current % size or current + size - 1 > merged_end:
+                        break
+                    length -= 1
+                prefixes.append((current, length, 1 << (32 - length)))
+                current += 1 << (32 - length)
+        merged_start, merged_end = start, end
+
+    # merge bottom-up into shorter prefixes that are covered well enough;
+    # each prefix carries how many of its addresses were really asked for
+    if max_overcoverage > 0:
+        for length in range(31, min_length - 1, -1):
+            mask = (0xffffffff << (32 - length)) & 0xffffffff
+            parents = collections.OrderedDict()
+            for prefix in prefixes:
+                if prefix[1] > length:
+                    parents.setdefault(prefix[0] & mask, []).append(prefix)
+                else:
+                    parents.setdefault((prefix[0], prefix[1]), []).append(prefix)
+            prefixes = []
+            for key, children in parents.iteritems():
+                covered = sum(x[2] for x in children)
+                if (isinstance(key, tuple) or len(children) < 2 or
+                        covered < (1 - max_overcoverage) * (1 << (32 - length))):
+                    prefixes.extend(children)
+                else:
+                    prefixes.append((key, length, covered))
+
+    aggregated = []
+    for network, length, covered in prefixes:
+        if length >= default_length:
+            aggregated.append(int_to_ip(network))
+        else:
+            aggregated.append(int_to_ip(network) + "/" + str(length))
+    return aggregated
+
+def numbered_groups(entries, group_limit, group_base):
+    """
+    Splits entries into groups of at most group_limit, in order, and yields
+    (group name, list of entries) for each. The group is named group_base
+    when everything fits in one group, and group_base_1, group_base_2, ...
+    otherwise.
+
+    Only one group's worth of entries (plus one) is read ahead, so entries
+    can be a generator over a file of any size.
+    """
+    iterator = iter(entries)
+    chunk = list(itertools.islice(iterator, group_limit + 1))
+    if len(chunk) <= group_limit:
+        if chunk:
+            yield group_base, chunk
+        return
+    number = 0
+    while chunk:
+        number += 1
+        yield group_base + "_" + str(number), chunk[:group_limit]
+        chunk = chunk[group_limit:]
+        chunk.extend(itertools.islice(iterator, group_limit - len(chunk)))
+
+def packed_groups(entries, group_limit, group_base, occupancy):
+    """
+    Like numbered_groups, but first tops up the existing groups in occupancy
+    (a dict of group name to number of members) that have room, fullest
+    first, so that a small batch doesn't open a new, nearly empty group.
+    What doesn't fit goes into new groups group_base_N, numbered after the
+    highest existing one. Yields (group name, list of entries).
+    """
+    iterator = iter(entries)
+    open_groups = sorted((group for group, count in occupancy.iteritems()
+                          if count < group_limit),
+                         key=lambda group: (-occupancy[group], group))
+    for group in open_groups:
+        chunk = list(itertools.islice(iterator, group_limit - occupancy[group]))
+        if not chunk:
+            return
+        yield group, chunk
+    prefix = group_base + "_"
+    number = max([int(group[len(prefix):]) for group in occupancy
+                  if group.startswith(prefix) and group[len(prefix):].isdigit()] or [0])
+    while True:
+        chunk = list(itertools.islice(iterator, group_limit))
+        if not chunk:
+            return
+        number += 1
+        yield prefix + str(number), chunk
+
+def plan_compaction(groups, group_limit, threshold):
+    """
+    Works out how to empty sparse groups into others with room, given the
+    members of each group (a dict of group name to set of names). Only groups
+    at most threshold (a fraction of group_limit) full are emptied, and the
+    fullest groups are kept, so that the fewest members move.
+
+    Returns (moves, emptied): a list of (name, from group, to group) and the
+    groups left empty.
+    """
+    # the fullest groups first; the ones above the threshold always stay
+    ordered = sorted(groups, key=lambda group: (-len(groups[group]), group))
+    keep = [group for group in ordered if len(groups[group]) > threshold * group_limit]
+    sparse = [group for group in ordered if group not in keep and groups[group]]
+    empty = [group for group in ordered if not groups[group]]
+    # keep the fullest sparse groups too until the rest fit in the kept ones
+    while sparse:
+        room = sum(group_limit - len(groups[group]) for group in keep)
+        if room >= sum(len(groups[group]) for group in sparse):
+            break
+        keep.append(sparse.pop(0))
+    moves = []
+    free = [[group, group_limit - len(groups[group])] for group in keep]
+    for group in sparse:
+        for name in sorted(groups[group]):
+            target = next(x for x in free if x[1] > 0)
+            moves.append((name, group, target[0]))
+            target[1] -= 1
+    return moves, sparse + empty
+
+DOTTED_QUAD = re.compile(r'^(25[0-5]|2[0-4]\d|1?\d?\d)(\.(25[0-5]|2[0-4]\d|1?\d?\d)){3}$')
+
+def pack_ipv4(text):
+    """
+    Returns the 4-byte network order form of a dotted quad, or raises
+    socket.error if text isn't exactly one.
+    """
+    if DOTTED_QUAD.match(text) is None:
+        raise socket.error("not an IPv4 address")
+    return socket.inet_aton(text)
+
+if hasattr(socket, "inet_pton"):
+    # much faster, and just as strict
+    pack_ipv4 = functools.partial(socket.inet_pton, socket.AF_INET)
+
+class AddressList(object):
+    """
+    Sorted, deduplicated addresses and prefixes, with the addresses packed as
+    32-bit integers in an array. Iterating over it yields them as strings
+    ("1.2.3.4" or "10.0.0.0/8") in order, so it can be used anywhere a list
+    of input lines can.
+    """
+    def __init__(self, hosts, networks, read=0, duplicates=0):
+        # array of the bare addresses, as integers
+        self.hosts = hosts
+        # sorted list of (network, prefix length)
+        self.networks = networks
+        # how many entries were read, and how many of them were repeats
+        self.read = read
+        self.duplicates = duplicates
+
+    def __len__(self):
+        return len(self.hosts) + len(self.networks)
+
+    def __iter__(self):
+        inet_ntoa = socket.inet_ntoa
+        pack = struct.Struct("!I").pack
+        if not self.networks:
+            for number in self.hosts:
+                yield inet_ntoa(pack(number))
+            return
+        hosts = ((number, 32) for number in self.hosts)
+        for number, length in heapq.merge(hosts, self.networks):
+            if length == 32:
+                yield inet_ntoa(pack(number))
+            else:
+                yield inet_ntoa(pack(number)) + "/" + str(length)
+
+def ingest_addresses(lines):
+    """
+    Parses, validates, sorts and deduplicates input lines before any of them
+    is turned into a command. Everything after a # is a comment; blank lines
+    are skipped. Prefixes ("10.0.0.0/8") are kept as prefixes, with any host
+    bits cleared.
+
+    Returns an AddressList and a list of (line number, line, reason) tuples
+    for the lines that aren't an IPv4 address or prefix.
+    """
+    hosts = array.array("I")
+    networks = set()
+    rejects = []
+    read = 0
+    lines = iter(lines)
+    first = 1
+    while True:
+        chunk = map(str.strip, itertools.islice(lines, 65536))
+        if not chunk:
+            break
+        # most chunks are nothing but addresses: pack them all at once
+        try:
+            hosts.fromstring("".join(map(pack_ipv4, chunk)))
+            read += len(chunk)
+            first += len(chunk)
+            continue
+        except socket.error:
+            pass
+        # the chunk has comments, blank lines, prefixes or bad lines in it
+        packed = []
+        for number, line in enumerate(chunk, first):
+            entry = line
+            if "#" in entry:
+                entry = entry.split("#", 1)[0].strip()
+            if not entry:
+                continue
+            read += 1
+            try:
+                packed.append(pack_ipv4(entry))
+                continue
+            except socket.error:
+                pass
+            ip, slash, length = entry.partition("/")
+            try:
+                network = struct.unpack("!I", pack_ipv4(ip))[0]
+                length = int(length)
+                if not 0 <= length <= 32:
+                    raise ValueError
+            except (socket.error, ValueError):
+                rejects.append((number, line, "not an IPv4 address or prefix"))
+                continue
+            if length == 32:
+                packed.append(pack_ipv4(ip))
+            else:
+                networks.add((network & ip_to_int(length_to_netmask(length)), length))
+        hosts.fromstring("".join(packed))
+        first += len(chunk)
+    if sys.byteorder == "little":
+        hosts.byteswap()
+
+    # sort and drop duplicates in bulk
+    try:
+        import numpy
+        unique = numpy.unique(numpy.frombuffer(hosts, dtype=numpy.uint32))
+        hosts = array.array("I")
+        hosts.fromstring(unique.tostring())
+    except ImportError:
+        hosts = array.array("I", sorted(set(hosts)))
+    networks = sorted(networks)
+    duplicates = read - len(rejects) - len(hosts) - len(networks)
+    return AddressList(hosts, networks, read, duplicates), rejects
+
+def print_ingest_report(addresses, rejects, limit=50):
+    """
+    Prints how many entries ingest_addresses read, kept and dropped, and the
+    first limit rejected lines.
+    """
+    print ("Read " + str(addresses.read) + " entries: " + str(len(addresses)) +
+           " unique, " + str(addresses.duplicates) + " duplicates, " +
+           str(len(rejects)) + " rejected")
+    for number, line, reason in rejects[:limit]:
+        print "  line " + str(number) + ": " + repr(line) + " (" + reason + ")"
+    if len(rejects) > limit:
+        print "  ... and " + str(len(rejects) - limit) + " more"
+
+class InputFile(object):
+    """
+    The lines of a file, read again from the start every time it's iterated
+    over, so that they never all have to be in memory at once.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path) as input:
+            for line in input:
+                yield line.rstrip()
+
+class CommandStream(object):
+    """
+    A sequence of commands generated on demand: every iteration calls
+    generate(*args) again, so the commands are never all in memory at once
+    and can still be printed first and run afterwards.
+    """
+    def __init__(self, generate, *args):
+        self.generate = generate
+        self.args = args
+
+    def __iter__(self):
+        return iter(self.generate(*self.args))
+
+@register_driver
+class SSG(BatchGroup):
+    """
+    An extension of the BatchGroup class with ScreenOS specifics.
+    """
+    device_type = "ssg"
+    prompt = SCREENOS_PROMPT
+    pager = SCREENOS_PAGER
+    newline = "\r"
+    error = SCREENOS_ERROR
+    # changes whenever the configuration does
+    config_marker_command = 'get checksum'
+
+    def __init__(self, ip_addrs=None, netmask=None,
+            addr_description="", addr_group_prefix=None, zone=None,
+            group_limit=None, hostname=None, ssh_user=None, ssh_pass=None,
+            window=None, port=None, bulk_load=False, sessions=1):
+
+        # sane defaults for ScreenOS systems
+        if netmask is None:
+            netmask = "255.255.255.255"
+        if addr_group_prefix is None:
+            addr_group_prefix = "Deny_addr"
+        if addr_description is None:
+            addr_description = date.today().isoformat()
+        if zone is None:
+            zone = "V1-Untrust"
+        if group_limit is None:
+            group_limit = 256            
+        if ssh_user is None:
+            ssh_user = "netscreen"
+        if window is None:
+            window = 1
+        if port is None:
+            port = 22
+
+        # check for blank list of IPs. If blank, throw exception.
+        if ip_addrs is None:
+            raise Exception("ip_addrs cannot be None.")
+
+        self.ip_addrs = ip_addrs
+        self.netmask = netmask
+        self.addr_description = addr_description
+        self.addr_group_prefix = addr_group_prefix
+        self.zone = zone
+        self.group_limit = group_limit
+        self.hostname = hostname
+        self.ssh_user = ssh_user
+        self.ssh_pass = ssh_pass
+        self.window = window
+        self.port = port
+        self.bulk_load = bulk_load
+        self.sessions = sessions
+        self.set_commands = CommandStream(gen_ssg_set_commands, ip_addrs, addr_group_prefix,
+                                addr_description, group_limit, zone, netmask)
+        self.get_results_command = 'get config'
+        self.get_config_command = self.get_results_command
+        self.unset_commands = CommandStream(gen_ssg_unset_commands, ip_addrs,
+                                addr_group_prefix, addr_description, group_limit, zone,
+                                netmask)
+        BatchGroup.__init__(self, self.set_commands, self.unset_commands,
+                self.hostname, self.ssh_user, self.ssh_pass)
+
+    @classmethod
+    def from_args(cls, ip_addresses, args, hostname, user):
+        return cls(ip_addrs=ip_addresses, netmask=args.netmask,
+                   addr_description=args.description,
+                   addr_group_prefix=args.action_description, zone=args.zone,
+                   group_limit=int(args.group_limit), hostname=hostname,
+                   ssh_user=user, window=int(args.window), port=int(args.port),
+                   bulk_load=args.bulk_load, sessions=int(args.sessions))
+
+    def __str__(self):
+        return BatchGroup.__str__(self)
+
+    def run_commands(self, commands):
+        """
+        Runs a list of commands on the device, in bulk or one at a time (over
+        several sessions at once with sessions > 1).
+        """
+        if self.bulk_load:
+            return load_via_tftp_ssg(commands, self.hostname, self.ssh_user,
+                    self.ssh_pass, port=self.port)
+        if self.sessions > 1:
+            return run_via_ssh_ssg_parallel(list(commands), self.hostname, self.ssh_user,
+                    self.ssh_pass, self.sessions, self.window, port=self.port,
+                    journal=self.journal)
+        return run_via_ssh_ssg(commands, self.hostname, self.ssh_user, self.ssh_pass,
+                self.window, port=self.port, journal=self.journal(commands))
+
+    def config_entries(self, lines):
+        return ssg_config_entries(lines)
+
+    def packed_set_commands(self, entries, occupancy):
+        return CommandStream(gen_ssg_set_commands, entries, self.addr_group_prefix,
+                             self.addr_description, self.group_limit, self.zone,
+                             self.netmask, occupancy)
+
+    def add_member_command(self, group, name):
+        return 'set group address "'+self.zone+'" "'+group+'" add "'+name+'"'
+
+    def remove_member_command(self, group, name):
+        return 'unset group address "'+self.zone+'" "'+group+'" remove "'+name+'"'
+
+    def remove_group_commands(self, group, members):
+        # "clear" empties the group in one command, whatever its size
+        return ['unset group address "'+self.zone+'" "'+group+'" clear',
+                'unset group address "'+self.zone+'" "'+group+'"']
+
+    def remove_address_command(self, name):
+        return 'unset address "'+self.zone+'" "'+name+'"'
+
+def screenos_errors(result):
+    """
+    Returns the error lines in result, the output of one ScreenOS command,
+    leaving out its first line: the echo of the command itself.
+    """
+    output = result.split("\n", 1)[1] if "\n" in result else ""
+    return SCREENOS_ERROR.findall(output)
+
+def run_via_ssh_ssg(commands, hostname, user, password, window=1, command_timeout=30,
+        port=22, journal=None, slot=0, unfinished=None):
+    """
+    Runs the command on the device via SSH with username+password
+    authentication. WARNING: does NOT verify the authenticity of the device.
+    DO NOT USE OVER UNTRUSTED CONNECTIONS!!!
+
+    Up to window commands are sent ahead without waiting for the device to
+    answer the earlier ones. Every prompt the device prints ends the output
+    of the oldest command still in flight, so errors are still matched to the
+    command that caused them. If the device's answers start lagging behind,
+    the window is halved; while they keep up it grows back to window.
+    window=1 sends each command only after the previous one's prompt.
+
+    With journal (a PushJournal), every answered command is recorded, and
+    the commands an earlier, interrupted run of the same list got through
+    are skipped. slot is the connection to use (see SessionManager). If the
+    run stops before the device has answered every command, the ones it
+    didn't answer are added to unfinished, if given.
+
+    Returns a list of (command, problem) tuples, empty if everything went fine.
+    """ 
+    # a shell on the (possibly already open) SSH connection to the device
+    paramiko.util.log_to_file("paramiko_log.txt")
+    METRICS.describe(hostname, "ssg")
+    channel = SESSIONS.open_shell(hostname, user, password, port, slot=slot)
+    reader = ChannelReader(channel, SCREENOS_PROMPT)
+
+    #trouble tracks socket.timeouts() and other errors
+    trouble = []
+    # set when the run stops before the device has answered every command
+    interrupted = False
+    try:
+        # the login banner and the first prompt
+        OUTPUT.write(reader.read_until_prompt(command_timeout) + "\n")
+    except (socket.timeout, EOFError) as e:
+        if isinstance(e, socket.timeout):
+            METRICS.count('timeouts', hostname)
+        trouble.append(("", str(e)))
+        if unfinished is not None:
+            unfinished.extend(commands)
+        commands = []
+        interrupted = True
+
+    # how many commands have been answered, this run or an earlier one
+    answered = 0
+    if journal is not None:
+        journal.open()
+        answered = journal.acked
+        if journal.resumed:
+            OUTPUT.write("Resuming after the first " + str(answered) +
+                         " commands, which an earlier run got through\n")
+
+    # the commands sent but not answered yet, with when they were sent,
+    # oldest first
+    in_flight = collections.deque()
+    # the current window; grows by about one command per window's worth of
+    # timely answers and is halved whenever the device lags
+    cwnd = 1.0
+    # running average of the time between two answers
+    gap_average = None
+    last_answer = time.time()
+    pending = itertools.islice(commands, answered, None)
+    exhausted = False
+    # the commands the device took, for the state store
+    acked = []
+    while True:
+        while not exhausted and len(in_flight) < int(cwnd):
+            try:
+                command = next(pending)
+            except StopIteration:
+                exhausted = True
+                break
+            # ScreenOS takes a carriage return as the end of a command, the
+            # same as the Enter key in a terminal
+            reader.send(command.rstrip() + "\r")
+            in_flight.append((command, time.time()))
+        if not in_flight:
+            break
+        command, sent = in_flight.popleft()
+        try:
+            result = reader.read_until_prompt(command_timeout)
+        except (socket.timeout, EOFError) as e:
+            # can't tell which later output would belong to which command
+            OUTPUT.write(reader.pending() + "\n")
+            if isinstance(e, socket.timeout):
+                METRICS.count('timeouts', hostname)
+            trouble.append((command, str(e)))
+            trouble.extend((x, "not answered") for x, _ in in_flight)
+            interrupted = True
+            if unfinished is not None:
+                unfinished.append(command)
+                unfinished.extend(x for x, _ in in_flight)
+                unfinished.extend(pending)
+            break
+        METRICS.observe('command_seconds', hostname, time.time() - sent)
+        METRICS.count('commands', hostname)
+        # prints out the prompt from the device, command, and result, if any
+        OUTPUT.write(result + "\n")
+        answered += 1
+        if journal is not None:
+            journal.ack(answered)
+
+        echoed = "".join(command.split()) in "".join(result.split())
+        if not echoed:
+            # the device dropped or garbled some of the input; stop sending ahead
+            trouble.append((command, "echo did not match, please check."))
+            cwnd = 1.0
+        errors = screenos_errors(result)
+        if errors:
+            METRICS.count('command_errors', hostname)
+            trouble.append((command, " ".join(x.strip() for x in errors)))
+        elif echoed and STATE.is_open():
+            acked.append(command)
+            if len(acked) >= 1000:
+                STATE.record(hostname, "ssg", acked)
+                acked = []
+
+        # halve the window when an answer takes much longer than usual
+        now = time.time()
+        gap = now - last_answer
+        last_answer = now
+        if gap_average is not None and gap > 4 * gap_average + 0.05:
+            cwnd = max(1.0, cwnd / 2)
+        else:
+            cwnd = min(float(window), cwnd + 1.0 / cwnd)
+        if gap_average is None:
+            gap_average = gap
+        else:
+            gap_average = 0.9 * gap_average + 0.1 * gap
+
+    STATE.record(hostname, "ssg", acked)
+    if journal is not None:
+        journal.close(finished=not interrupted)
+    for command, problem in trouble:
+        OUTPUT.write("Had trouble with " + command + ": " + problem + "\n")
+    OUTPUT.flush()
+    # close the channel; the connection stays open for the next run
+    started = time.time()
+    channel.close()
+    METRICS.observe('teardown_seconds', hostname, time.time() - started)
+    reader.report(hostname)
+    return trouble
+
+# what an SSG address book command does: the verb, "address" or "group
+# address", the address or group name, and the address a group gets
+SSG_COMMAND_KIND = re.compile(r'^(set|unset) (address|group address) "[^"]*" "([^"]*)"'
+                              r'(?: add "([^"]*)")?')
+
+def ssg_phases(commands):
+    """
+    Splits SSG commands into phases that have to run one after the other,
+    each a list of lanes: commands that have to run in that order, but in
+    any order relative to the other lanes of the phase, so that the lanes can
+    go to different sessions.
+
+    "set address" commands depend on nothing, so the ones before the first
+    "unset" command make the first phase, one lane each. Nothing depends on
+    an address being gone, so "unset address" commands make the last phase,
+    one lane each (or come before a "set address" command that follows
+    them). The others are taken in order, consecutive commands of the same
+    kind making a phase: group commands get one lane per group (ScreenOS
+    makes a group with its first member), and anything else a single lane.
+    """
+    addresses = []
+    removals = []
+    phases = []
+    current = None
+    unset_seen = False
+    for command in commands:
+        match = SSG_COMMAND_KIND.match(command)
+        kind = match.group(1, 2) if match else None
+        if kind == ("set", "address") and not unset_seen:
+            addresses.append([command])
+            continue
+        if kind == ("unset", "address"):
+            unset_seen = True
+            removals.append([command])
+            continue
+        if command.startswith("unset "):
+            unset_seen = True
+        if kind == ("set", "address") and removals:
+            phases.append(removals)
+            removals = []
+            current = None
+        if kind != current or not phases:
+            current = kind
+            phases.append(collections.OrderedDict())
+        lanes = phases[-1]
+        if kind is None:
+            lane = None
+        elif kind[1] == "address":
+            lane = len(lanes)
+        else:
+            lane = match.group(3)
+        lanes.setdefault(lane, []).append(command)
+    phases = [lanes.values() if isinstance(lanes, dict) else lanes for lanes in phases]
+    if addresses:
+        phases.insert(0, addresses)
+    if removals:
+        phases.append(removals)
+    return phases
+
+def spread_lanes(lanes, count):
+    """
+    Deals lanes (lists of commands) out to up to count sessions, biggest
+    first and each to the session with the fewest commands so far, and
+    returns each session's commands.
+    """
+    shares = [[] for _ in range(min(count, len(lanes)))]
+    sizes = [(0, index) for index in range(len(shares))]
+    for lane in sorted(lanes, key=len, reverse=True):
+        size, index = heapq.heappop(sizes)
+        shares[index].extend(lane)
+        heapq.heappush(sizes, (size + len(lane), index))
+    return shares
+
+def run_via_ssh_ssg_parallel(commands, hostname, user, password, sessions, window=1,
+        command_timeout=30, port=22, journal=None):
+    """
+    Runs commands on the device like run_via_ssh_ssg, but over up to
+    sessions SSH connections at once: each phase of ssg_phases is dealt out
+    to them (see spread_lanes), and a phase only starts once the device has
+    answered all of the one before, so addresses exist before they're put
+    in groups. An address the device printed an error for, or never
+    answered, isn't put in a group, and if a session stops early (or fails
+    outright, e.g. can't connect), the later phases aren't run; what the
+    other sessions reported is kept either way.
+
+    journal(commands), if given, returns the PushJournal for one session's
+    share of a phase, or None. Those are all kept until the whole push is
+    through, so that running it again skips whatever any session got
+    through.
+
+    Returns a list of (command, problem) tuples, empty if everything went fine.
+    """
+    trouble = []
+    journals = []
+    # the addresses that couldn't be set
+    failed = set()
+    phases = ssg_phases(commands)
+    for number, lanes in enumerate(phases):
+        # the problems found here rather than by run_via_ssh_ssg
+        problems = []
+        if failed:
+            kept = []
+            for lane in lanes:
+                runnable = []
+                for command in lane:
+                    match = SSG_COMMAND_KIND.match(command)
+                    if match and match.group(1) == "set" and match.group(4) in failed:
+                        problems.append((command, "not run, the address wasn't set"))
+                    else:
+                        runnable.append(command)
+                if runnable:
+                    kept.append(runnable)
+            lanes = kept
+        shares = spread_lanes(lanes, sessions)
+        OUTPUT.write("Phase %d of %d: %d commands over %d sessions\n"
+                     % (number + 1, len(phases), sum(len(x) for x in shares), len(shares)))
+        results = [[] for _ in shares]
+        unfinished = []
+
+        def run(slot, share):
+            share_journal = journal(share) if journal is not None else None
+            if share_journal is not None:
+                share_journal.keep = True
+                journals.append(share_journal)
+            try:
+                results[slot] = run_via_ssh_ssg(share, hostname, user, password, window,
+                        command_timeout, port, share_journal, slot, unfinished)
+            except Exception as e:
+                # keep what the other sessions found, and stop after this phase
+                results[slot] = [("", "%s: %s" % (e.__class__.__name__, e))]
+                unfinished.extend(share)
+
+        run_parallel(run, enumerate(shares), len(shares))
+        unanswered = set(unfinished)
+        for result in results:
+            trouble.extend(result)
+            for command, problem in result:
+                # a garbled echo alone doesn't mean the address isn't there;
+                # problem holds only the error lines of screenos_errors, never
+                # the echo, so words in a description can't match here
+                match = SSG_COMMAND_KIND.match(command)
+                if (match and match.group(1, 2) == ("set", "address") and
+                        (command in unanswered or SCREENOS_ERROR.match(problem))):
+                    failed.add(match.group(3))
+        if unfinished and number + 1 < len(phases):
+            problems.append(("", "a session stopped early, so the phases after phase %d"
+                             " weren't run" % (number + 1)))
+        for command, problem in problems:
+            OUTPUT.write("Had trouble with " + command + ": " + problem + "\n")
+        trouble.extend(problems)
+        if unfinished:
+            break
+    else:
+        for share_journal in journals:
+            share_journal.discard()
+    OUTPUT.flush()
+    return trouble
+
+class TFTPServer(object):
+    """
+    A minimal read-only TFTP server (RFC 1350) that serves files from memory,
+    for devices that can only pull a configuration file over TFTP. Serves in
+    a background thread until stop() is called.
+    """
+    BLOCK_SIZE = 512
+
+    def __init__(self, files, address="", port=69, timeout=2, retries=5):
+        # files maps a file name to its contents
+        self.files = files
+        self.timeout = timeout
+        self.retries = retries
+        # the names of the files that have been sent completely
+        self.served = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.address, self.port = self.sock.getsockname()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        """
+        Answers read requests until stopped. Each transfer gets its own socket
+        and thread, as the protocol asks.
+        """
+        self.sock.settimeout(0.5)
+        while not self.stopped.is_set():
+            try:
+                packet, client = self.sock.recvfrom(self.BLOCK_SIZE + 4)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            thread = threading.Thread(target=self.send_file, args=(packet, client))
+            thread.daemon = True
+            thread.start()
+
+    def send_file(self, packet, client):
+        """
+        Sends the file asked for by a read request, one block at a time,
+        waiting for each block to be acknowledged.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.address, 0))
+        sock.settimeout(self.timeout)
+        try:
+            opcode = struct.unpack("!H", packet[:2])[0]
+            if opcode != 1:
+                sock.sendto(struct.pack("!HH", 5, 4) + "only reads are supported\0", client)
+                return
+            name, mode = packet[2:].split("\0")[:2]
+            if name not in self.files:
+                sock.sendto(struct.pack("!HH", 5, 1) + "file not found\0", client)
+                return
+            data = self.files[name]
+            if mode.lower() == "netascii":
+                data = data.replace("\r\n", "\n").replace("\n", "\r\n")
+            block = 1
+            while True:
+                chunk = data[(block-1)*self.BLOCK_SIZE:block*self.BLOCK_SIZE]
+                reply = struct.pack("!HH", 3, block & 0xffff) + chunk
+                if not self.send_block(sock, reply, client, block & 0xffff):
+                    return
+                # a short block (possibly empty) ends the transfer
+                if len(chunk) < self.BLOCK_SIZE:
+                    self.served.append(name)
+                    return
+                block += 1
+        finally:
+            sock.close()
+
+    def send_block(self, sock, reply, client, block):
+        """
+        Sends one DATA packet until the client acknowledges it. Returns False
+        if it never does.
+        """
+        for attempt in range(self.retries):
+            sock.sendto(reply, client)
+            try:
+                while True:
+                    ack, sender = sock.recvfrom(self.BLOCK_SIZE + 4)
+                    if sender != client or len(ack) < 4:
+                        continue
+                    opcode, acked = struct.unpack("!HH", ack[:4])
+                    if opcode == 5:
+                        return False
+                    if opcode == 4 and acked == block:
+                        return True
+            except socket.timeout:
+                continue
+        return False
+
+    def stop(self):
+        """
+        Stops answering requests and frees the port.
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.sock.close()
+
+def local_address_towards(hostname, port=22):
+    """
+    Returns the local IP address the OS would use to reach hostname, which is
+    the address the device should use to reach us back. Nothing is sent.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((hostname, port))
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+# a line of a merged file that ScreenOS couldn't apply, as it appears in the
+# problems run_via_ssh_ssg reports (error lines joined by spaces)
+MERGE_FAILED = re.compile(r'[Ff]ailed command - (.+?)(?=\s+[Ff]ailed command - |$)')
+
+def load_via_tftp_ssg(commands, hostname, user, password, tftp_address=None, tftp_port=69,
+        command_timeout=600, port=22):
+    """
+    Applies a list of commands to an SSG device in one step instead of typing
+    them one at a time: the commands are served as a file from a local TFTP
+    server, and the device is told to merge that file into its configuration.
+
+    tftp_address is the address the device should fetch the file from;
+    by default it's the local address used to reach the device. ScreenOS
+    always asks on port 69, so tftp_port is only useful against a stand-in.
+
+    The device keeps whatever lines of the file merged, even if others
+    failed; each line it says failed is reported on its own, and the
+    configuration is read back so that the state store records the others.
+    If it can't be read, every line the device didn't say failed is
+    recorded.
+
+    Returns a list of (command, problem) tuples, empty if everything went fine.
+    """
+    if tftp_address is None:
+        tftp_address = local_address_towards(hostname, port)
+    filename = "bulk_ip_add_%d_%d.txt" % (os.getpid(), int(time.time()))
+    data = "\n".join(x.rstrip() for x in commands) + "\n"
+    server = TFTPServer({filename: data}, port=tftp_port)
+    try:
+        merge = "save config from tftp " + tftp_address + " " + filename + " merge"
+        trouble = run_via_ssh_ssg([merge], hostname, user, password,
+                                  command_timeout=command_timeout, port=port)
+    finally:
+        server.stop()
+    # the lines of the file the device said it couldn't merge, one problem each
+    failed = []
+    problems = []
+    for command, problem in trouble:
+        lines = MERGE_FAILED.findall(problem) if command == merge else []
+        if lines:
+            failed.extend(lines)
+        else:
+            problems.append((command, problem))
+    trouble = problems + [(line, "failed in the merge") for line in failed]
+    if filename in server.served:
+        METRICS.count('bytes_sent', hostname, len(data))
+        if not trouble:
+            STATE.record(hostname, "ssg", commands)
+        elif STATE.is_open():
+            # ScreenOS keeps the lines that merged, so record what the
+            # configuration shows of them
+            try:
+                config = run_show_command('get config', hostname, user, password,
+                        SCREENOS_PROMPT, SCREENOS_PAGER, "\r", port=port)
+                STATE.record(hostname, "ssg", applied_commands(
+                        commands, ConfigIndex(ssg_config_entries(config.splitlines()))))
+            except (socket.timeout, EOFError, paramiko.SSHException) as e:
+                if problems:
+                    OUTPUT.write(hostname + ": not recorded in the state store, since the"
+                                 " merge had trouble and the configuration couldn't be"
+                                 " read: " + str(e) + "\n")
+                else:
+                    failed = set(failed)
+                    STATE.record(hostname, "ssg", (x for x in commands
+                                                   if x.strip() not in failed))
+    elif not trouble:
+        trouble.append((merge, "the device never fetched " + filename))
+    return trouble
+
+def gen_ssg_set_commands(ip_addrs, addr_group_prefix, addr_description, group_limit, zone,
+        netmask, occupancy=None):
+    """
+    Yields the "set" commands for SSG devices, one group's worth of addresses
+    at a time: the addresses of a group, then the commands adding them to
+    it. Entries can be bare addresses (which get netmask) or prefixes such as
+    1.2.3.0/24. With occupancy, existing groups with room are filled first
+    (see packed_groups).
+    
+    NOTE: this is automatically done when instantiating a SSG
+    BatchGroup.
+    """
+    group_base = addr_group_prefix+'_'+addr_description
+    if occupancy is None:
+        groups = numbered_groups(ip_addrs, group_limit, group_base)
+    else:
+        groups = packed_groups(ip_addrs, group_limit, group_base, occupancy)
+    for group, entries in groups:
+        names = []
+        # formats the "set address" commands
+        for entry in entries:
+            name, ip, mask, length = address_parts(entry, netmask)
+            names.append(name)
+            yield ('set address "'+zone+'" "'+name+'" '+ip+' '+mask+
+                    ' "'+addr_description+'"')
+        # formats the "set group address" commands
+        for name in names:
+            yield 'set group address "'+zone+'" "'+group+'" add "'+name+'"'
+
+def gen_ssg_unset_commands(ip_addrs, addr_group_prefix, addr_description, group_limit, zone,
+        netmask):
+    """
+    Yields the "unset" commands for SSG devices, one group at a time: the
+    one emptying the group ("clear"), the one removing it, then the ones
+    removing the addresses. That's two commands per group plus one per
+    address, as the groups are this batch's own.
+
+    NOTE: this is automatically done when instantiating a SSG 
+    BatchGroup.
+    """
+    group_base = addr_group_prefix+'_'+addr_description
+    for group, entries in numbered_groups(ip_addrs, group_limit, group_base):
+        names = [address_parts(entry, netmask)[0] for entry in entries]
+        # the commands to empty and remove the address group object
+        yield 'unset group address "'+zone+'" "'+group+'" clear'
+        yield 'unset group address "'+zone+'" "'+group+'"'
+        # formats the "unset address" commands
+        for name in names:
+            yield 'unset address "'+zone+'" "'+name+'"'
+
+SSG_ADDRESS = re.compile(r'^set address "([^"]*)" "([^"]*)" (\S+)(?: (\d+\.\d+\.\d+\.\d+))?')
+SSG_GROUP = re.compile(r'^set group address "([^"]*)" "([^"]*)"(?: add "([^"]*)")?')
+
+def ssg_config_entries(lines):
+    """
+    Yields the address book entries found in ScreenOS configuration lines (the
+    output of "get config", or generated commands) as (kind, zone, name,
+    value) tuples:
+        ("address", zone, name, "ip netmask")
+        ("group", zone, group, None)
+        ("member", zone, group, address name)
+    """
+    for line in lines:
+        line = line.strip()
+        match = SSG_ADDRESS.match(line)
+        if match:
+            zone, name, ip, netmask = match.groups()
+            yield ("address", zone, name, ip + " " + (netmask or ""))
+            continue
+        match = SSG_GROUP.match(line)
+        if match:
+            zone, group, member = match.groups()
+            if member is None:
+                yield ("group", zone, group, None)
+            else:
+                yield ("member", zone, group, member)
+
+@register_driver
+class SRX(BatchGroup):
+    """
+    An extension of the BatchGroup class with SRX specifics.
+    """
+    device_type = "srx"
+    prompt = JUNOS_PROMPT
+    pager = JUNOS_PAGER
+    newline = "\n"
+    error = JUNOS_ERROR
+    # the commit history gains a line with every commit
+    config_marker_command = 'show system commit'
+
+    def __init__(self, ip_addrs=None, netmask=None,
+            addr_description="", addr_group_prefix=None, zone=None,
+            group_limit=None, hostname=None, ssh_user=None, ssh_pass=None,
+            port=None, bulk_load=False, commit_size=None, adaptive_commit=False,
+            confirm_minutes=None, coalesce=None):
+
+        # sane defaults for SRX systems
+        if netmask is None:
+            netmask = "255.255.255.255"
+        if addr_group_prefix is None:
+            addr_group_prefix = "Deny_addr"
+        if addr_description is None:
+            addr_description = date.today().isoformat()
+        if zone is None:
+            zone = "V1-Untrust"
+        if group_limit is None:
+            group_limit = 256 
+        if ssh_user is None:
+            # Assume we want root access? TODO: figure out default user
+            ssh_user = "root"
+        if port is None:
+            port = 22
+
+        self.ip_addrs = ip_addrs
+        self.netmask = netmask
+        self.addr_description = addr_description
+        self.addr_group_prefix = addr_group_prefix
+        self.zone = zone
+        self.group_limit = group_limit
+        self.hostname = hostname
+        self.ssh_user = ssh_user
+        self.ssh_pass = ssh_pass
+        self.port = port
+        self.bulk_load = bulk_load
+        self.commit_size = commit_size
+        self.adaptive_commit = adaptive_commit
+        self.confirm_minutes = confirm_minutes
+        self.coalesce = coalesce
+        self.set_commands = CommandStream(gen_srx_set_commands, ip_addrs, addr_group_prefix,
+                                addr_description, group_limit, zone, netmask, None,
+                                coalesce)
+        self.delete_commands = CommandStream(gen_srx_delete_commands, ip_addrs,
+                                addr_group_prefix, addr_description, group_limit, zone,
+                                netmask)
+        self.get_results_command = 'show configuration | display set'
+        self.get_config_command = ('show configuration security zones security-zone '+zone+
+                                   ' address-book | display set | no-more')
+        BatchGroup.__init__(self, self.set_commands, self.delete_commands,
+                self.hostname, self.ssh_user, self.ssh_pass)
+
+    @classmethod
+    def from_args(cls, ip_addresses, args, hostname, user):
+        return cls(ip_addrs=ip_addresses, netmask=args.netmask,
+                   addr_description=args.description,
+                   addr_group_prefix=args.action_description, zone=args.zone,
+                   group_limit=int(args.group_limit), hostname=hostname,
+                   ssh_user=user, port=int(args.port), bulk_load=args.bulk_load,
+                   commit_size=int(args.commit_size or 0) or None,
+                   adaptive_commit=args.adaptive_commit,
+                   confirm_minutes=int(args.confirm_minutes or 0) or None,
+                   coalesce=int(args.coalesce or 0) or None)
+
+    def run_commands(self, commands):
+        """
+        Runs a list of commands on the device, in bulk (in one commit) or one
+        at a time.
+        """
+        if self.bulk_load:
+            return load_via_sftp_srx(commands, self.hostname, self.ssh_user,
+                    self.ssh_pass, port=self.port)
+        return run_via_ssh_srx(commands, self.hostname, self.ssh_user, self.ssh_pass,
+                port=self.port, commit_size=self.commit_size,
+                adaptive=self.adaptive_commit, confirm_minutes=self.confirm_minutes,
+                journal=self.journal(commands))
+
+    def config_entries(self, lines):
+        return srx_config_entries(lines)
+
+    def packed_set_commands(self, entries, occupancy):
+        return CommandStream(gen_srx_set_commands, entries, self.addr_group_prefix,
+                             self.addr_description, self.group_limit, self.zone,
+                             self.netmask, occupancy, self.coalesce)
+
+    def add_member_command(self, group, name):
+        return ('set security zones security-zone '+self.zone+' address-book'
+            ' address-set '+group+' address '+name)
+
+    def remove_member_command(self, group, name):
+        return ('delete security zones security-zone '+self.zone+' address-book'
+            ' address-set '+group+' address '+name)
+
+    def add_members_commands(self, group, names):
+        if not self.coalesce:
+            return BatchGroup.add_members_commands(self, group, names)
+        return list(bracketed('set security zones security-zone '+self.zone+
+                              ' address-book address-set '+group+' address',
+                              names, self.coalesce))
+
+    def remove_members_commands(self, group, names):
+        if not self.coalesce:
+            return BatchGroup.remove_members_commands(self, group, names)
+        return list(bracketed('delete security zones security-zone '+self.zone+
+                              ' address-book address-set '+group+' address',
+                              names, self.coalesce))
+
+    def remove_group_commands(self, group, members):
+        return ['delete security zones security-zone '+self.zone+' address-book'
+            ' address-set '+group]
+
+    def remove_address_command(self, name):
+        return ('delete security zones security-zone '+self.zone+' address-book'
+            ' address '+name)
+
+class CommitSizer(object):
+    """
+    Decides how many addresses go into each commit of a chunked SRX push.
+
+    Without adaptive, every chunk is size addresses. With adaptive, size is
+    only the starting point: after each chunk the size is moved by factor in
+    the same direction as long as the addresses per second (sending plus
+    committing) improve, and turned around when they get worse, staying
+    between minimum and maximum.
+    """
+    def __init__(self, size, adaptive=False, minimum=10, maximum=5000, factor=1.5):
+        self.size = size
+        self.adaptive = adaptive
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        # 1 to grow the chunks, -1 to shrink them
+        self.direction = 1
+        self.last_rate = None
+
+    def record(self, addresses, seconds):
+        """
+        Takes note of how long a chunk of addresses took, and picks the size
+        of the next one.
+        """
+        if not self.adaptive or addresses == 0:
+            return
+        rate = addresses / max(seconds, 0.001)
+        if self.last_rate is not None and rate < self.last_rate:
+            self.direction = -self.direction
+        self.last_rate = rate
+        self.size = int(round(self.size * self.factor ** self.direction))
+        self.size = min(max(self.size, self.minimum), self.maximum)
+
+SRX_ADDRESS_COMMAND = re.compile(r'^(set|delete) security zones security-zone \S+ address-book'
+                                 r' address \S')
+
+# the lines of "show | compare" for uncommitted changes
+JUNOS_CHANGE = re.compile(r'^[+-]\s', re.M)
+
+def run_via_ssh_srx(commands, hostname, user, password, command_timeout=30,
+        commit_timeout=300, port=22, commit_size=None, adaptive=False,
+        confirm_minutes=None, journal=None, atomic=False):
+    """
+    Runs a list of configuration commands on a juniper device using password
+    authentication. All of the commands are run in the same shell session,
+    between a "configure"/"rollback" and a "commit check"/"commit".
+
+    Each command is sent as soon as the device prints its prompt for the
+    previous one. A command that makes the device print an error, or that
+    gets no prompt back within command_timeout seconds (commit_timeout for
+    the commits), is reported. If a commit fails, the changes are rolled back
+    instead of committed.
+
+    With commit_size, the changes are committed every commit_size addresses
+    instead of only at the end, so a failure late in a long batch only costs
+    the last chunk, and how long each chunk took is printed. With adaptive,
+    the chunk size is tuned as the push goes (see CommitSizer). With
+    confirm_minutes, every commit but the last is a "commit confirmed", which
+    the device rolls back by itself if the next commit doesn't come within
+    that many minutes; its changes only count as committed (in the journal
+    and the state store) once the next commit has gone through.
+
+    With journal (a PushJournal), every answered command and every commit is
+    recorded. A run of the same commands after an interrupted one doesn't
+    start with "rollback": it carries on after the last answered command if
+    the candidate configuration still holds the uncommitted changes, or
+    after the last commit if it doesn't.
+
+    With atomic, the first command the device prints an error for rolls all
+    of the changes back and ends the run, so that nothing is committed (e.g.
+    a "load set" that only took part of its file).
+
+    Returns a list of (command, problem) tuples, empty if everything went fine.
+    """
+    METRICS.describe(hostname, "srx")
+    trouble = []
+    channel = None
+    # the commands the device took since the last commit, for the state store
+    acked = []
+    # how far the last "commit confirmed" got and the commands it committed,
+    # until a later commit confirms it
+    pending = []
+    # how many commands have been answered, this run or an earlier one
+    position = [0]
+    # the output of the last command run
+    last = [""]
+    finished = False
+    try:
+        #a shell on the (possibly already open) SSH connection to the device
+        channel = SESSIONS.open_shell(hostname, user, password, port)
+        reader = ChannelReader(channel, JUNOS_PROMPT)
+
+        def run(command, timeout=command_timeout):
+            """
+            Sends one command and waits for the prompt after it. Returns False
+            if the device printed an error. A timeout is reported and raised,
+            since later output couldn't be matched to its command anymore.
+            """
+            #Must put a new line at the end of each command
+            started = time.time()
+            reader.send(command.rstrip() + '\n')
+            #Print out what the SRX machine is running and saying
+            try:
+                result = reader.read_until_prompt(timeout)
+            except (socket.timeout, EOFError) as e:
+                OUTPUT.write(reader.pending() + "\n")
+                if isinstance(e, socket.timeout):
+                    METRICS.count('timeouts', hostname)
+                trouble.append((command, str(e)))
+                raise
+            if command.startswith('commit'):
+                METRICS.observe('commit_seconds', hostname, time.time() - started)
+            else:
+                METRICS.observe('command_seconds', hostname, time.time() - started)
+            METRICS.count('commands', hostname)
+            OUTPUT.write(result + "\n")
+            last[0] = result
+            errors = JUNOS_ERROR.findall(result)
+            if errors:
+                METRICS.count('command_errors', hostname)
+                trouble.append((command, " ".join(x.strip() for x in errors)))
+                return False
+            return True
+
+        def commit(final):
+            """
+            Commits the changes so far; the final commit is checked first.
+            Returns False, after rolling the changes back, if it failed.
+            """
+            confirmed = confirm_minutes and not final
+            if final:
+                committed = run('commit check', commit_timeout) and run('commit', commit_timeout)
+            elif confirmed:
+                committed = run('commit confirmed ' + str(confirm_minutes), commit_timeout)
+            else:
+                committed = run('commit', commit_timeout)
+            if not committed:
+                #Don't leave a candidate that doesn't check out
+                run('rollback')
+                run('exit')
+            else:
+                # any commit confirms the "commit confirmed" before it
+                if pending:
+                    record_commit(*pending.pop())
+                if confirmed:
+                    pending.append((position[0], list(acked)))
+                else:
+                    record_commit(position[0], acked)
+            del acked[:]
+            return committed
+
+        def record_commit(count, done):
+            """
+            Records that the first count commands, done among them since the
+            commit before, are in the device's configuration for good.
+            """
+            STATE.record(hostname, "srx", done)
+            if journal is not None:
+                journal.commit(count)
+
+        #Wait for the login banner and the first prompt
+        try:
+            OUTPUT.write(reader.read_until_prompt(command_timeout) + "\n")
+        except (socket.timeout, EOFError) as e:
+            if isinstance(e, socket.timeout):
+                METRICS.count('timeouts', hostname)
+            trouble.append(("", str(e)))
+            raise
+        #configure - enter config mode
+        #rollback - clear out any config changes to start clear - roll back to last committed config
+        run('configure')
+        if journal is not None:
+            journal.open()
+        if journal is not None and journal.resumed:
+            # whatever the earlier run left uncommitted is only still there
+            # if nothing rolled it back since
+            run('show | compare')
+            if JUNOS_CHANGE.search(last[0]):
+                position[0] = journal.acked
+                # the earlier run's uncommitted commands go in with the next
+                # commit
+                if STATE.is_open():
+                    acked.extend(itertools.islice(commands, journal.committed,
+                                                  journal.acked))
+            else:
+                position[0] = journal.committed
+            OUTPUT.write("Resuming after the first " + str(position[0]) + " commands, which"
+                         " an earlier run got through\n")
+        else:
+            run('rollback')
+        sizer = None
+        if commit_size:
+            sizer = CommitSizer(commit_size, adaptive)
+        in_chunk = 0
+        chunk_started = time.time()
+        for command in itertools.islice(commands, position[0], None):
+            if sizer is not None and SRX_ADDRESS_COMMAND.match(command):
+                # commit before the first address that doesn't fit in the chunk
+                if in_chunk >= sizer.size:
+                    commit_started = time.time()
+                    if not commit(final=False):
+                        break
+                    now = time.time()
+                    OUTPUT.write("Committed %d addresses in %.1f seconds (%.1f for the commit)\n"
+                                 % (in_chunk, now - chunk_started, now - commit_started))
+                    sizer.record(in_chunk, now - chunk_started)
+                    in_chunk = 0
+                    chunk_started = now
+                in_chunk += 1
+            if run(command):
+                if STATE.is_open():
+                    acked.append(command)
+            elif atomic:
+                run('rollback')
+                run('exit')
+                break
+            position[0] += 1
+            if journal is not None:
+                journal.ack(position[0])
+        else:
+            #commit check - verify pending commit
+            #commit - commit changes
+            #exit - exit config mode
+            if commit(final=True):
+                finished = True
+                run('exit')
+    except paramiko.AuthenticationException:
+        OUTPUT.write("Authentication failed.\n")
+        trouble.append(("", "Authentication failed."))
+    except (socket.timeout, EOFError):
+        # already reported by whatever timed out
+        pass
+    if journal is not None:
+        journal.close(finished)
+    #the connection stays open for the next run
+    if channel is not None:
+        started = time.time()
+        channel.close()
+        METRICS.observe('teardown_seconds', hostname, time.time() - started)
+        reader.report(hostname)
+    for command, problem in trouble:
+        OUTPUT.write("Had trouble with " + command + ": " + problem + "\n")
+    OUTPUT.flush()
+    return trouble
+
+def load_via_sftp_srx(commands, hostname, user, password, remote_dir="/var/tmp",
+        command_timeout=30, commit_timeout=300, port=22):
+    """
+    Applies a list of set/delete commands to an SRX device in one step instead
+    of typing them one at a time: the commands are uploaded over SFTP as a
+    set-format file, loaded with "load set" and committed once, or rolled
+    back if the device reports an error for any of it. The file is removed
+    from the device afterwards.
+
+    Returns a list of (command, problem) tuples, empty if everything went fine.
+    """
+    try:
+        sftp = SESSIONS.open_sftp(hostname, user, password, port)
+    except paramiko.AuthenticationException:
+        OUTPUT.write("Authentication failed.\n")
+        OUTPUT.flush()
+        return [("", "Authentication failed.")]
+    remote_path = remote_dir + "/bulk_ip_add_%d_%d.set" % (os.getpid(), int(time.time()))
+    try:
+        remote_file = sftp.open(remote_path, "w")
+        remote_file.set_pipelined(True)
+        sent = 0
+        for command in commands:
+            line = command.rstrip() + "\n"
+            remote_file.write(line)
+            sent += len(line)
+        remote_file.close()
+        METRICS.count('bytes_sent', hostname, sent)
+        trouble = run_via_ssh_srx(["load set " + remote_path], hostname, user, password,
+                                  command_timeout=commit_timeout,
+                                  commit_timeout=commit_timeout, port=port, atomic=True)
+        if not trouble:
+            STATE.record(hostname, "srx", commands)
+        else:
+            OUTPUT.write(hostname + ": the load had trouble, so none of it was committed\n")
+        sftp.remove(remote_path)
+    finally:
+        sftp.close()
+    return trouble
+
+def gen_srx_set_commands(ip_addrs, addr_group_descr, addr_description, group_limit, zone,
+        netmask, occupancy=None, coalesce=None):
+    """
+    Yields the "set" commands for SRX devices. Entries can be bare addresses
+    (which get the prefix length of netmask) or prefixes such as 1.2.3.0/24.
+    With occupancy, existing address-sets with room are filled first (see
+    packed_groups).
+
+    With coalesce, each group's addresses are set first and then put in the
+    address-set up to coalesce at a time, as "[ a b c ]" lists (see
+    bracketed), instead of one command per address.
+    """
+    # formats the address set commands
+    # TODO: should we use "untrust" in place of "V1-Untrust" for the zones?
+    # I.e., should we translate from netscreen zones to "srx" zones? Is there
+    # even a difference in practice?
+
+    # create multiple groups, if necessary, using group_limit
+    group_base = addr_group_descr+'_'+addr_description
+    if occupancy is None:
+        groups = numbered_groups(ip_addrs, group_limit, group_base)
+    else:
+        groups = packed_groups(ip_addrs, group_limit, group_base, occupancy)
+    for group, entries in groups:
+        if coalesce:
+            names = []
+            for entry in entries:
+                name, ip, mask, length = address_parts(entry, netmask)
+                names.append(name)
+                yield ('set security zones security-zone '+zone+' address-book'
+                    ' address '+name+' '+ip+'/'+str(length))
+            for command in bracketed('set security zones security-zone '+zone+
+                                     ' address-book address-set '+group+' address',
+                                     names, coalesce):
+                yield command
+            continue
+        for entry in entries:
+            name, ip, mask, length = address_parts(entry, netmask)
+            yield ('set security zones security-zone '+zone+' address-book'
+                ' address '+name+' '+ip+'/'+str(length))
+            yield ('set security zones security-zone '+zone+' address-book'
+                ' address-set '+group+' address '+name)
+
+# the longest command line sent to an SRX; longer "[ ... ]" lists are split
+SRX_LINE_LIMIT = 1024
+
+def bracketed(head, values, size, limit=SRX_LINE_LIMIT):
+    """
+    Yields the Junos commands giving head each of values, with up to size
+    of them per command as a "[ a b c ]" list and no command longer than
+    limit characters. A value on its own isn't put in brackets.
+    """
+    lines = [[]]
+    # head, " [ ", the values and a space after each, "]"
+    length = len(head) + 4
+    for value in values:
+        if lines[-1] and (len(lines[-1]) >= size or length + len(value) + 1 > limit):
+            lines.append([])
+            length = len(head) + 4
+        lines[-1].append(value)
+        length += len(value) + 1
+    for line in lines:
+        if len(line) == 1:
+            yield head + ' ' + line[0]
+        elif line:
+            yield head + ' [ ' + ' '.join(line) + ' ]'
+
+def bracket_values(value):
+    """
+    Returns the values of a Junos "[ a b c ]" list, or [value] for a single
+    value.
+    """
+    if value.startswith("["):
+        return value.strip("[] ").split()
+    return [value]
+
+def gen_srx_delete_commands(ip_addrs, addr_group_descr, addr_description, group_limit, zone,
+        netmask):
+    """
+    Yields the "delete" commands for SRX devices: one deleting each
+    address-set with all of its members, then one per address. As the sets
+    are this batch's own, that's one command per group plus one per address.
+    """
+    # formats the delete commands
+    # uses group_limit as necessary
+    group_base = addr_group_descr+'_'+addr_description
+    for group, entries in numbered_groups(ip_addrs, group_limit, group_base):
+        yield ('delete security zones security-zone '+zone+' address-book'
+            ' address-set '+group)
+        for entry in entries:
+            name, ip, mask, length = address_parts(entry, netmask)
+            yield ('delete security zones security-zone '+zone+' address-book'
+                ' address '+name)
+
+SRX_ADDRESS = re.compile(r'^set security zones security-zone (\S+) address-book address (\S+) (\S+)')
+SRX_MEMBER = re.compile(r'^set security zones security-zone (\S+) address-book address-set (\S+)'
+                        r' address (\[[^\]]*\]|\S+)')
+
+def srx_config_entries(lines):
+    """
+    Yields the address book entries found in Junos "display set" lines (or
+    generated commands) as (kind, zone, name, value) tuples:
+        ("address", zone, name, "ip/prefix length")
+        ("member", zone, address-set, address name)
+    """
+    for line in lines:
+        line = line.strip()
+        match = SRX_ADDRESS.match(line)
+        if match:
+            yield ("address",) + match.groups()
+            continue
+        match = SRX_MEMBER.match(line)
+        if match:
+            zone, group, value = match.groups()
+            for name in bracket_values(value):
+                yield ("member", zone, group, name)
+
+SSG_UNSET = re.compile(r'^unset (address|group address) "([^"]*)" "([^"]*)"'
+                       r'(?: remove "([^"]*)"|( clear))?')
+SRX_DELETE = re.compile(r'^delete security zones security-zone (\S+) address-book (address|address-set)'
+                        r' (\S+)(?: address (\[[^\]]*\]|\S+))?')
+
+def command_changes(command):
+    """
+    Returns what an address book command of either device type does, as
+    (added, entries): added is True for set commands and False for
+    unset/delete ones, and entries are (kind, zone, name, value) tuples like
+    those of ssg_config_entries and srx_config_entries (with no value for
+    removals, and for a member removal, no value means every member of the
+    group). Other commands give (None, []).
+    """
+    command = command.strip()
+    if command.startswith("set "):
+        if command.startswith("set security "):
+            return True, list(srx_config_entries([command]))
+        return True, list(ssg_config_entries([command]))
+    match = SSG_UNSET.match(command)
+    if match:
+        kind, zone, name, member, clear = match.groups()
+        if kind == "address":
+            return False, [("address", zone, name, None)]
+        if clear:
+            return False, [("member", zone, name, None)]
+        if member is None:
+            return False, [("group", zone, name, None)]
+        return False, [("member", zone, name, member)]
+    match = SRX_DELETE.match(command)
+    if match:
+        zone, kind, name, member = match.groups()
+        if kind == "address":
+            return False, [("address", zone, name, None)]
+        if member is None:
+            return False, [("group", zone, name, None)]
+        return False, [("member", zone, name, x) for x in bracket_values(member)]
+    return None, []
+
+def applied_commands(commands, live):
+    """
+    Yields the address book commands whose effect shows in live (a
+    ConfigIndex of the device's configuration), e.g. to tell which lines of a
+    partly failed bulk load the device took.
+    """
+    for command in commands:
+        added, entries = command_changes(command)
+        if added is None:
+            continue
+        for kind, zone, name, value in entries:
+            if kind == "address":
+                present = (zone, name) in live.addresses
+            elif kind == "group":
+                present = (zone, name) in live.groups
+            elif value is None:
+                # a cleared group has no members left
+                present = bool(live.groups.get((zone, name)))
+            else:
+                present = value in live.groups.get((zone, name), ())
+            if present != added:
+                break
+        else:
+            yield command
+
+def address_range(value):
+    """
+    Returns the first and last address covered by an address value ("ip
+    netmask" on SSG, "ip/length" on SRX) as integers, or (None, None) if it
+    isn't an IPv4 address or prefix.
+    """
+    try:
+        if "/" in value:
+            ip, length = value.split("/")
+            length = int(length)
+        else:
+            ip, netmask = value.split()
+            length = netmask_to_length(netmask)
+        first = ip_to_int(ip) & ((0xffffffff << (32 - length)) & 0xffffffff)
+    except (ValueError, socket.error):
+        return None, None
+    return first, first + (1 << (32 - length)) - 1
+
+class SQLiteStore(object):
+    """
+    A local SQLite file with the tables of SCHEMA, shared by the threads of a
+    run (with lock held around every use of db). Does nothing until open()
+    is called.
+    """
+    SCHEMA = ""
+
+    def __init__(self):
+        self.db = None
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # names and values come back as they went in, not as unicode
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+
+    def is_open(self):
+        return self.db is not None
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+class StateStore(SQLiteStore):
+    """
+    A local SQLite record of what has been pushed to which device: every
+    address object (with the range of addresses it covers) and every group
+    membership, by device and zone. Commands are recorded once the device
+    has acknowledged them (on SRX, once they're committed), so removals,
+    audits and re-pushes can be answered with indexed lookups instead of the
+    original input file or the device's configuration.
+
+    Does nothing until open() is called. Safe to use from several threads.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS devices (
+            device TEXT PRIMARY KEY, device_type TEXT, updated REAL);
+        CREATE TABLE IF NOT EXISTS addresses (
+            device TEXT, zone TEXT, name TEXT, value TEXT,
+            first INTEGER, last INTEGER, pushed REAL,
+            PRIMARY KEY (device, zone, name));
+        CREATE INDEX IF NOT EXISTS addresses_by_first ON addresses (first, last);
+        CREATE TABLE IF NOT EXISTS groups (
+            device TEXT, zone TEXT, name TEXT, pushed REAL,
+            PRIMARY KEY (device, zone, name));
+        CREATE TABLE IF NOT EXISTS members (
+            device TEXT, zone TEXT, grp TEXT, name TEXT, pushed REAL,
+            PRIMARY KEY (device, zone, grp, name));
+        CREATE INDEX IF NOT EXISTS members_by_name ON members (device, zone, name);
+        CREATE TABLE IF NOT EXISTS expiries (
+            device TEXT, zone TEXT, name TEXT, expires REAL,
+            PRIMARY KEY (device, zone, name));
+        CREATE INDEX IF NOT EXISTS expiries_by_time ON expiries (expires);
+    """
+
+    def record(self, hostname, device_type, commands):
+        """
+        Records the effect of commands the device has acknowledged, in one
+        transaction. Commands that aren't about the address book are ignored.
+        """
+        if self.db is None:
+            return
+        now = time.time()
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO devices VALUES (?, ?, ?)",
+                                (hostname, device_type, now))
+                for command in commands:
+                    added, entries = command_changes(command)
+                    for kind, zone, name, value in entries:
+                        self.apply(hostname, added, kind, zone, name, value, now)
+
+    def apply(self, hostname, added, kind, zone, name, value, now):
+        db = self.db
+        if kind == "address" and added:
+            first, last = address_range(value)
+            db.execute("INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (hostname, zone, name, value, first, last, now))
+        elif kind == "address":
+            db.execute("DELETE FROM addresses WHERE device=? AND zone=? AND name=?",
+                       (hostname, zone, name))
+            db.execute("DELETE FROM members WHERE device=? AND zone=? AND name=?",
+                       (hostname, zone, name))
+            db.execute("DELETE FROM expiries WHERE device=? AND zone=? AND name=?",
+                       (hostname, zone, name))
+        elif kind == "group" and added:
+            db.execute("INSERT OR IGNORE INTO groups VALUES (?, ?, ?, ?)",
+                       (hostname, zone, name, now))
+        elif kind == "group":
+            db.execute("DELETE FROM groups WHERE device=? AND zone=? AND name=?",
+                       (hostname, zone, name))
+            db.execute("DELETE FROM members WHERE device=? AND zone=? AND grp=?",
+                       (hostname, zone, name))
+        elif added:
+            db.execute("INSERT OR IGNORE INTO groups VALUES (?, ?, ?, ?)",
+                       (hostname, zone, name, now))
+            db.execute("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)",
+                       (hostname, zone, name, value, now))
+        elif value is None:
+            # ScreenOS "clear" empties the group but keeps it
+            db.execute("DELETE FROM members WHERE device=? AND zone=? AND grp=?",
+                       (hostname, zone, name))
+        else:
+            db.execute("DELETE FROM members WHERE device=? AND zone=? AND grp=? AND name=?",
+                       (hostname, zone, name, value))
+            # Junos drops an address-set with its last member
+            if not db.execute("SELECT 1 FROM members WHERE device=? AND zone=? AND grp=?"
+                              " LIMIT 1", (hostname, zone, name)).fetchone():
+                if db.execute("SELECT device_type FROM devices WHERE device=?",
+                              (hostname,)).fetchone()[0] == "srx":
+                    db.execute("DELETE FROM groups WHERE device=? AND zone=? AND name=?",
+                               (hostname, zone, name))
+
+    def knows(self, hostname):
+        """
+        Returns True if anything was ever recorded for hostname.
+        """
+        if self.db is None:
+            return False
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM devices WHERE device=?",
+                                   (hostname,)).fetchone() is not None
+
+    def entries(self, hostname, zone=None):
+        """
+        Returns what was pushed to hostname (in zone, if given) as the
+        (kind, zone, name, value) entries ConfigIndex is built from.
+        """
+        if self.db is None:
+            return []
+        where = "device=?" + (" AND zone=?" if zone is not None else "")
+        params = (hostname,) + ((zone,) if zone is not None else ())
+        with self.lock:
+            entries = [("address", z, name, value) for z, name, value in self.db.execute(
+                "SELECT zone, name, value FROM addresses WHERE " + where, params)]
+            entries.extend(("group", z, name, None) for z, name in self.db.execute(
+                "SELECT zone, name FROM groups WHERE " + where, params))
+            entries.extend(("member", z, group, name) for z, group, name in self.db.execute(
+                "SELECT zone, grp, name FROM members WHERE " + where, params))
+        return entries
+
+    def set_expiry(self, hostname, zone, names, expires):
+        """
+        Records that the addresses names on hostname expire at expires (a
+        time.time() value). Names the store has no address object for are
+        left out.
+        """
+        if self.db is None:
+            return
+        with self.lock:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO expiries SELECT device, zone, name, ?"
+                    " FROM addresses WHERE device=? AND zone=? AND name=?",
+                    ((expires, hostname, zone, name) for name in names))
+
+    def forget_expiries(self, hostname, zone, names):
+        """
+        Drops the expiry of the addresses names on hostname, if any.
+        """
+        if self.db is None:
+            return
+        with self.lock:
+            with self.db:
+                self.db.executemany(
+                    "DELETE FROM expiries WHERE device=? AND zone=? AND name=?",
+                    ((hostname, zone, name) for name in names))
+
+    def expiries(self, until=None, hostname=None):
+        """
+        Returns the recorded expiries as (expires, device, zone, name)
+        tuples, soonest first: all of them, or those due by until, or those
+        of hostname.
+        """
+        if self.db is None:
+            return []
+        conditions = []
+        params = ()
+        if until is not None:
+            conditions.append("expires <= ?")
+            params += (until,)
+        if hostname is not None:
+            conditions.append("device = ?")
+            params += (hostname,)
+        query = "SELECT expires, device, zone, name FROM expiries"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self.lock:
+            return self.db.execute(query + " ORDER BY expires", params).fetchall()
+
+    def find(self, ip):
+        """
+        Returns the address objects covering ip on any device, as a list of
+        (device, device_type, zone, name, value, groups) tuples. Looks up
+        each possible prefix of ip in the index rather than scanning.
+        """
+        if self.db is None:
+            return []
+        number = ip_to_int(ip)
+        firsts = sorted(set(number & ((0xffffffff << (32 - length)) & 0xffffffff)
+                            for length in range(33)))
+        found = []
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT a.device, d.device_type, a.zone, a.name, a.value FROM addresses a"
+                " LEFT JOIN devices d ON d.device = a.device"
+                " WHERE a.first IN (" + ",".join("?" * len(firsts)) + ") AND a.last >= ?"
+                " ORDER BY a.device, a.zone, a.name", firsts + [number]).fetchall()
+            for device, device_type, zone, name, value in rows:
+                groups = [x for (x,) in self.db.execute(
+                    "SELECT grp FROM members WHERE device=? AND zone=? AND name=?"
+                    " ORDER BY grp", (device, zone, name))]
+                found.append((device, device_type, zone, name, value, groups))
+        return found
+
+# what was pushed where, once --state is given
+STATE = StateStore()
+
+class ConfigCache(SQLiteStore):
+    """
+    A local SQLite copy of the address book of each device's configuration,
+    by device and zone, stored as the parsed entries ConfigIndex is built
+    from, together with the config marker (see BatchGroup.config_marker) the
+    device gave when it was downloaded. A copy is only used while the device
+    still gives the same marker, so a large configuration is downloaded and
+    parsed again only after it has changed.
+
+    Does nothing until open() is called. Safe to use from several threads.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            device TEXT, zone TEXT, marker TEXT, fetched REAL,
+            PRIMARY KEY (device, zone));
+        CREATE TABLE IF NOT EXISTS entries (
+            device TEXT, zone TEXT, kind TEXT, entry_zone TEXT, name TEXT, value TEXT);
+        CREATE INDEX IF NOT EXISTS entries_by_device ON entries (device, zone);
+    """
+
+    def entries(self, hostname, zone, marker):
+        """
+        Returns the cached (kind, zone, name, value) entries of hostname's
+        zone if they were taken when the device gave marker, otherwise None.
+        """
+        if self.db is None or marker is None:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT marker FROM snapshots WHERE device=? AND zone=?",
+                                  (hostname, zone)).fetchone()
+            if row is None or row[0] != marker:
+                return None
+            return self.db.execute("SELECT kind, entry_zone, name, value FROM entries"
+                                   " WHERE device=? AND zone=?", (hostname, zone)).fetchall()
 
-    def print_remove_settings_commands(self):
+    def store(self, hostname, zone, marker, entries):
         """
-        Prints out the commands to remove the settings from the device.
+        Replaces the copy of hostname's zone with entries, taken when the
+        device gave marker. Nothing is stored without a marker.
         """
-        for command in self.remove_settings_commands:
-            print command
+        if self.db is None or marker is None:
+            return
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM entries WHERE device=? AND zone=?",
+                                (hostname, zone))
+                self.db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                                    ((hostname, zone) + tuple(entry) for entry in entries))
+                self.db.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)",
+                                (hostname, zone, marker, time.time()))
 
-class SSG(BatchGroup):
+CACHE = ConfigCache()
+
+class PushJournal(object):
     """
-    An extension of the BatchGroup class with ScreenOS specifics.
+    A write-ahead record of how far a push of a list of commands to one
+    device got, so that a push that died partway (a dropped connection, a
+    timeout, Ctrl-C) can be picked up again instead of starting over.
+
+    The journal is a text file in directory named after the device and a
+    digest of the commands: a "begin" line, then "ack N" once the device has
+    answered the first N commands and, on SRX, "commit N" once the first N
+    are committed. Running the same commands again finds it and resumes;
+    a push that gets to the end removes it, unless keep is set, in which
+    case it stays until discard().
     """
-    def __init__(self, ip_addrs=None, netmask=None,
-            addr_description="", addr_group_prefix=None, zone=None,
-            group_limit=None, hostname=None, ssh_user=None, ssh_pass=None):
+    def __init__(self, directory, hostname, commands):
+        digest = hashlib.sha1()
+        for command in commands:
+            digest.update(command + "\n")
+        self.digest = digest.hexdigest()
+        self.path = os.path.join(directory, hostname + "-" + self.digest[:16] + ".journal")
+        # how many commands the device answered, and how many are committed
+        self.acked = 0
+        self.committed = 0
+        self.resumed = False
+        self.keep = False
+        self.file = None
 
-        # sane defaults for ScreenOS systems
-        if netmask is None:
-            netmask = "255.255.255.255"
-        if addr_group_prefix is None:
-            addr_group_prefix = "Deny_addr"
-        if addr_description is None:
-            addr_description = date.today().isoformat()
-        if zone is None:
-            zone = "V1-Untrust"
-        if group_limit is None:
-            group_limit = 256            
-        if ssh_user is None:
-            ssh_user = "netscreen"
+    def open(self):
+        """
+        Reads what an earlier run of the same commands got through, if
+        anything, and starts recording.
+        """
+        if not os.path.isdir(os.path.dirname(self.path) or "."):
+            os.makedirs(os.path.dirname(self.path))
+        if os.path.exists(self.path):
+            with open(self.path) as journal:
+                lines = journal.read().splitlines()
+            if lines and lines[0] == "begin " + self.digest:
+                for line in lines[1:]:
+                    words = line.split()
+                    # the last line may have been cut short
+                    if len(words) != 2 or not words[1].isdigit():
+                        continue
+                    if words[0] == "ack":
+                        self.acked = int(words[1])
+                    elif words[0] == "commit":
+                        self.committed = int(words[1])
+                self.resumed = self.acked > 0
+        if self.resumed:
+            self.file = open(self.path, "a")
+        else:
+            self.file = open(self.path, "w")
+            self.file.write("begin " + self.digest + "\n")
+            self.sync()
 
-        # check for blank list of IPs. If blank, throw exception.
-        if ip_addrs is None:
-            raise Exception("ip_addrs cannot be None.")
+    def ack(self, count):
+        """
+        Records that the device has answered the first count commands.
+        """
+        self.acked = count
+        self.file.write("ack %d\n" % count)
+        self.file.flush()
 
-        self.ip_addrs = ip_addrs
-        self.netmask = netmask
-        self.addr_description = addr_description
-        self.addr_group_prefix = addr_group_prefix
-        self.zone = zone
-        self.group_limit = group_limit
-        self.hostname = hostname
-        self.ssh_user = ssh_user
-        self.ssh_pass = ssh_pass
-        self.set_commands = gen_ssg_set_commands(ip_addrs, addr_group_prefix,
-                                addr_description, group_limit, zone, netmask)
-        self.get_results_command = 'get config'
-        self.unset_commands = gen_ssg_unset_commands(ip_addrs, addr_group_prefix,
-                                addr_description, group_limit, zone, netmask)
-        BatchGroup.__init__(self, self.set_commands, self.unset_commands,
-                self.hostname, self.ssh_user, self.ssh_pass)
+    def commit(self, count):
+        """
+        Records that the first count commands are committed (SRX).
+        """
+        self.committed = count
+        self.file.write("commit %d\n" % count)
+        self.sync()
 
-    def __str__(self):
-        return BatchGroup.__str__(self)
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
 
-    def run_add_settings_commands(self):
+    def close(self, finished):
         """
-        Runs the commands to add the settings to the device.
+        Stops recording; a finished push needs no resuming, so its journal
+        is removed.
         """
-        run_via_ssh_ssg(self.set_commands, self.hostname, self.ssh_user, self.ssh_pass)
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if finished and not self.keep:
+            os.remove(self.path)
 
-    def run_remove_settings_commands(self):
+    def discard(self):
         """
-        Runs the commands to remove the settings from the device.
+        Removes the journal, once the push it belongs to needs no resuming.
         """
-        run_via_ssh_ssg(self.unset_commands, self.hostname, self.ssh_user, self.ssh_pass)
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
-def run_via_ssh_ssg(commands, hostname, user, password):
+def load_inventory(path):
     """
-    Runs the command on the device via SSH with username+password
-    authentication. WARNING: does NOT verify the authenticity of the device.
-    DO NOT USE OVER UNTRUSTED CONNECTIONS!!!
-    """ 
-    # low-level setup of an SSH connection using the paramiko library
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((hostname, 22))
-    tport = paramiko.Transport(sock)
-    paramiko.util.log_to_file("paramiko_log.txt")
-    tport.start_client()
-    channel = tport.open_session()
-    channel.set_combine_stderr(True)
-    channel.setblocking(blocking=0)
-    channel.settimeout(timeout = 0.5)
-    tport.auth_password(user, password)
-    channel.invoke_shell()
-    time.sleep(0.4)
-
-    # instead of doing one command per ssh session, now run through the
-    # whole list of commands in one session
-    result=""
-    #trouble tracks socket.timeouts() and other errors
-    trouble=""
-    for command in commands:
-        # send the command and get the results
-        channel.send(command.rstrip()+"\r\n")
-        coutstring=""
-        result=""
-        
-        # prints out the prompt from the device, command, and result, if any
-        try:
-            while not channel.closed:
-                coutstring = channel.recv(1024)
-                result += coutstring
-                if len(coutstring) < 1024:
-                    break
-            print result
-        except:
-            trouble += "Had trouble with " + command + ", please check."
-    # there's one command result that needs to be retrieved and must be done
-    # outside the for loop. And sometimes there's nothing there.
-    try:
-        final_result = ""
-        while not channel.closed:
-            coutstring = channel.recv(1024)
-            final_result += coutstring
-            if len(coutstring) < 1024:
-                break
-        print final_result.replace(result, "")
-    except:
-        trouble += "Had trouble with " + command + ", please check."
-    print trouble
-    # close the connection
-    channel.close()
-    tport.close()
-    sock.close()
+    Reads a device inventory: one device per line, as
+    "<hostname> [<device type>] [<user>]". The device type defaults to ssg and
+    the user to the device type's default user. Blank lines and lines starting
+    with # are skipped, and so are devices listed again, so that no device
+    gets two batches pushed to it at the same time.
 
-def gen_ssg_set_commands(ip_addrs, addr_group_prefix, addr_description, group_limit, zone,
-        netmask):
+    Returns a list of (hostname, device_type, user) tuples.
     """
-    Returns a list of "set" commands for SSG devices.
-    
-    NOTE: this is automatically done when instantiating a SSG
-    BatchGroup.
+    devices = []
+    seen = set()
+    for line in open(path):
+        fields = line.split()
+        if not fields or fields[0].startswith("#"):
+            continue
+        hostname = fields[0]
+        if hostname in seen:
+            print "Skipping " + hostname + ": it's already in the inventory"
+            continue
+        seen.add(hostname)
+        device_type = fields[1] if len(fields) > 1 else "ssg"
+        user = fields[2] if len(fields) > 2 else None
+        devices.append((hostname, device_type, user))
+    return devices
+
+def run_threads(target, jobs):
     """
-    # the list to hold the commands
-    commands = []
-       
-    # formats the "set address" commands
-    for ip in ip_addrs:
-        ip = ip.rstrip()
-        command = ('set address "'+zone+'" "'+ip+'" '+ip+' '+netmask+
-                ' "'+addr_description+'"')
-        commands.append(command)
-
-    # figure out the necessary number of address groups
-    num_of_groups = math.floor((len(ip_addrs)-1)/group_limit)
-    count_ips = 1
-    
-    # formats the "set group address" commands
-    # determine group numbers and append to group names
-    for ip in ip_addrs:
-        ip = ip.rstrip()
-        if num_of_groups > 0:
-            group_num = int(math.floor((count_ips-1)/group_limit)) + 1
-            multiple_groups = "_" + str(group_num)
-        else:
-            multiple_groups = ""
-        command = ('set group address "'+zone+'"'
-            ' "'+addr_group_prefix+'_'+addr_description+multiple_groups+'" add "'+ip+'"')
-        commands.append(command)
-        count_ips += 1
-    
-    # return the generated commands
-    return commands
+    Calls target(*job) for every job in jobs, each on a thread of its own,
+    and waits for all of them.
+    """
+    threads = []
+    for job in jobs:
+        thread = threading.Thread(target=target, args=job)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        # join with a timeout so that Ctrl-C still gets through
+        while thread.is_alive():
+            thread.join(1)
 
-def gen_ssg_unset_commands(ip_addrs, addr_group_prefix, addr_description, group_limit, zone,
-        netmask):
+def run_batches(batches, action="add", max_connections=8):
     """
-    Returns a list of "unset" commands for SSG devices.
+    Runs the add (action="add"), remove (action="remove") or sync
+    (action="sync") commands of several batches at the same time, one thread
+    per batch, so that the whole run takes about as long as the slowest
+    device. At most max_connections batches are connected at once; how many
+    sessions each of them opens to its device is up to the batch (--sessions).
 
-    NOTE: this is automatically done when instantiating a SSG 
-    BatchGroup.
+    Returns one dict per batch, in the same order, with the hostname, the
+    device type, the number of seconds the batch took and the list of
+    (command, problem) tuples the run reported.
+    """
+    connections = threading.BoundedSemaphore(max_connections)
+    results = [None] * len(batches)
+
+    def run(index, batch):
+        result = {'hostname': batch.hostname,
+                  'device_type': batch.device_type,
+                  'seconds': 0.0, 'trouble': []}
+        with connections:
+            start = time.time()
+            try:
+                method = getattr(batch, "run_" + action + "_settings_commands")
+                result['trouble'] = method() or []
+            except Exception as e:
+                result['trouble'] = [("", "%s: %s" % (e.__class__.__name__, e))]
+            result['seconds'] = time.time() - start
+        results[index] = result
+
+    run_threads(run, enumerate(batches))
+    return results
+
+def print_run_summary(results):
     """
-    # the list to hold the commands
-    commands = []
-
-    # formats the "unset group address" commands
-    num_of_groups = math.floor(len(ip_addrs)/group_limit)
-    count_ips = 1
-    # determine group numbers and append to group names
-    for ip in ip_addrs:
-        ip = ip.rstrip()
-        if num_of_groups > 0:
-            group_num = int(math.floor((count_ips-1)/group_limit)) + 1
-            multiple_groups = "_" + str(group_num)
+    Prints one line per device from the results of run_batches, followed by
+    any problems it reported.
+    """
+    print "%-30s %-4s %10s  %s" % ("DEVICE", "TYPE", "SECONDS", "STATUS")
+    for result in results:
+        if result['trouble']:
+            status = "%d problem(s)" % len(result['trouble'])
         else:
-            multiple_groups = ""
-        command = ('unset group address "'+zone+'"'
-            ' "'+addr_group_prefix+'_'+addr_description+multiple_groups+'" remove "'+ip+'"')
-        commands.append(command)
-        count_ips += 1
-
-    # add the command to remove the address group object    
-    num_of_groups = int(math.floor((len(ip_addrs)-1)/group_limit)) + 1
-    # if there's group_limit or fewer ip's, don't append group number
-    if num_of_groups == 1:
-        commands.append('unset group address'+
-        ' "'+zone+'" "'+addr_group_prefix+'_'+addr_description+'"')
+            status = "ok"
+        print "%-30s %-4s %10.1f  %s" % (result['hostname'], result['device_type'],
+                                         result['seconds'], status)
+    for result in results:
+        for command, problem in result['trouble']:
+            print result['hostname'] + ": had trouble with " + command + ": " + problem
+
+def make_batch(device_type, ip_addresses, args, hostname, user):
+    """
+    Returns the batch for one device of one of the DRIVERS, set up from the
+    CLI arguments.
+    """
+    if device_type not in DRIVERS:
+        raise Exception("Device type not recognized")
+    return DRIVERS[device_type].from_args(ip_addresses, args, hostname, user)
+
+def write_commands(commands, path):
+    """
+    Writes commands to the file at path, one per line.
+    """
+    with open(path, "w") as output:
+        output.writelines(command + "\n" for command in commands)
+
+def run_parallel(function, jobs, workers=8):
+    """
+    Calls function(*job) for every job in jobs, on up to workers threads at
+    once, and waits for all of them. Raises the first exception any of them
+    raised.
+    """
+    queue = Queue.Queue()
+    for job in jobs:
+        queue.put(job)
+    errors = []
+
+    def work():
+        while True:
+            try:
+                job = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                function(*job)
+            except Exception as e:
+                errors.append(e)
+
+    run_threads(work, [()] * min(workers, queue.qsize()))
+    if errors:
+        raise errors[0]
+
+def compile_batches(batches, directory, workers=8):
+    """
+    Writes the add and remove commands of every batch to
+    directory/<hostname>.add.txt and directory/<hostname>.remove.txt without
+    connecting to any device. Unless a driver says otherwise
+    (same_commands_per_type), the commands are generated once per kind of
+    device and the other devices of that kind get copies of the files.
+
+    Returns the number of files written.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    generated = {}
+    writes = []
+    copies = []
+    for batch in batches:
+        for action, commands in (("add", batch.add_settings_commands),
+                                 ("remove", batch.remove_settings_commands)):
+            path = os.path.join(directory, batch.hostname + "." + action + ".txt")
+            key = (batch.device_type, action)
+            if batch.same_commands_per_type and key in generated:
+                if path != generated[key]:
+                    copies.append((generated[key], path))
+                continue
+            if batch.same_commands_per_type:
+                generated[key] = path
+            writes.append((commands, path))
+    run_parallel(write_commands, writes, workers)
+    run_parallel(shutil.copyfile, copies, workers)
+    return len(writes) + len(copies)
+
+def make_batches(ip_addresses, args, parser):
+    """
+    Returns one batch per device to run on: the one on the command line or
+    every device in the inventory.
+    """
+    if args.inventory:
+        devices = load_inventory(args.inventory)
+    elif args.device_address:
+        devices = [(args.device_address, args.device_type, args.user)]
     else:
-        for group in range(1, num_of_groups+1):
-            multiple_groups = "_" + str(group)
-            commands.append('unset group address'+
-            ' "'+zone+'" "'+addr_group_prefix+'_'+addr_description+multiple_groups+'"')       
+        parser.error("either device-address or --inventory is required")
 
-    # formats the "unset address" commands
-    for ip in ip_addrs:
-        command = 'unset address "'+zone+'" "'+ip+'"'
-        commands.append(command)
+    # determine which type of batch we should use for each device
+    batches = [make_batch(device_type, ip_addresses, args, hostname, user)
+               for hostname, device_type, user in devices]
+    for batch in batches:
+        batch.use_state = bool(args.state)
+        batch.journal_dir = args.journal
+        batch.pack_groups = args.pack_groups
+        if args.compact:
+            batch.compact = float(args.compact)
+        if args.ttl:
+            batch.ttl = parse_duration(args.ttl)
+    return batches
 
-    # return the generated commands
-    return commands
+def ask_passwords(batches):
+    """
+    Prompts once per user for the password of the batches that don't have one
+    yet. The BULK_IP_ADD_PASSWORD environment variable, if set, is used for
+    every user instead, for runs with no one at the terminal.
+    """
+    passwords = {}
+    for batch in batches:
+        if batch.ssh_pass is None:
+            if "BULK_IP_ADD_PASSWORD" in os.environ:
+                batch.ssh_pass = os.environ["BULK_IP_ADD_PASSWORD"]
+                continue
+            if batch.ssh_user not in passwords:
+                passwords[batch.ssh_user] = getpass.getpass(
+                    "Enter password for user '"+batch.ssh_user+"': ")
+            batch.ssh_pass = passwords[batch.ssh_user]
 
-class SRX(BatchGroup):
+def print_found(ip, found):
     """
-    An extension of the BatchGroup class with SRX specifics.
+    Prints where the state store says ip is blocked (see StateStore.find).
     """
-    def __init__(self, ip_addrs=None, netmask=None,
-            addr_description="", addr_group_prefix=None, zone=None,
-            group_limit=None, hostname=None, ssh_user=None, ssh_pass=None):
+    if not found:
+        print ip + " is not in any address object pushed to a device"
+        return
+    print "%-30s %-4s %-20s %-25s %s" % ("DEVICE", "TYPE", "ZONE", "ADDRESS", "GROUPS")
+    for device, device_type, zone, name, value, groups in found:
+        print "%-30s %-4s %-20s %-25s %s" % (device, device_type or "", zone, name,
+                                            ", ".join(groups) or "-")
 
-        # sane defaults for SRX systems
-        if netmask is None:
-            netmask = "255.255.255.255"
-        if addr_group_prefix is None:
-            addr_group_prefix = "Deny_addr"
-        if addr_description is None:
-            addr_description = date.today().isoformat()
-        if zone is None:
-            zone = "V1-Untrust"
-        if group_limit is None:
-            group_limit = 256 
-        if ssh_user is None:
-            # Assume we want root access? TODO: figure out default user
-            ssh_user = "root"
+def finish_run(metrics_prefix=None):
+    """
+    Closes the connections to the devices and the session log and, with
+    metrics_prefix, writes the metrics of the run to metrics_prefix.json and
+    metrics_prefix.prom.
+    """
+    SESSIONS.close()
+    OUTPUT.close()
+    STATE.close()
+    CACHE.close()
+    if metrics_prefix:
+        METRICS.write_json(metrics_prefix + ".json")
+        METRICS.write_prometheus(metrics_prefix + ".prom")
+        print "Wrote metrics to " + metrics_prefix + ".json and " + metrics_prefix + ".prom"
 
-        self.ip_addrs = ip_addrs
-        self.netmask = netmask
-        self.addr_description = addr_description
-        self.addr_group_prefix = addr_group_prefix
-        self.zone = zone
-        self.group_limit = group_limit
-        self.hostname = hostname
-        self.ssh_user = ssh_user
-        self.ssh_pass = ssh_pass
-        self.set_commands = gen_srx_set_commands(ip_addrs, addr_group_prefix,
-                                addr_description, group_limit, zone, netmask)
-        self.delete_commands = gen_srx_delete_commands(ip_addrs, addr_group_prefix,
-                                addr_description, group_limit, zone, netmask)
-        self.get_results_command = 'show configuration | display set'
-        BatchGroup.__init__(self, self.set_commands, self.delete_commands,
-                self.hostname, self.ssh_user, self.ssh_pass)
+class FeedReader(object):
+    """
+    Reads addresses, one per line, from a live feed on threads of its own and
+    queues the lines for get(). The source can be:
+        "-" for standard in (the feed ends with it)
+        "unix:PATH" for a Unix socket created at PATH, which any number of
+        clients can connect to and write lines into
+        the path of a named pipe (FIFO), opened again whenever the writer
+        closes it
+        the path of any other file, followed like "tail -F" from its current
+        end, starting over if it's truncated or replaced (rotated)
+    """
+    # how often a followed file is checked for new lines, in seconds
+    poll_seconds = 0.5
 
-    def run_add_settings_commands(self):
+    def __init__(self, source):
+        self.source = source
+        self.queue = Queue.Queue()
+        self.listener = None
+
+    def start(self):
+        if self.source == "-":
+            target = self.read_stdin
+        elif self.source.startswith("unix:"):
+            path = self.source[len("unix:"):]
+            if os.path.exists(path):
+                os.remove(path)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(path)
+            self.listener.listen(16)
+            target = self.accept
+        elif stat.S_ISFIFO(os.stat(self.source).st_mode):
+            target = self.read_fifo
+        else:
+            target = self.follow_file
+        self.spawn(target)
+
+    def spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def get(self, timeout):
         """
-        Runs the commands to add the settings to the device.
+        Returns the next line, "" if none came within timeout seconds, or None
+        once the feed has ended.
         """
-        commands = ("\nconfigure\n" + "\n".join(x for x in (self.set_commands)) +
-                    "\ncommit check\n" + "commit\n" + "exit\n")
-        run_via_ssh_srx(self.set_commands, self.hostname, self.ssh_user, self.ssh_pass)
+        try:
+            return self.queue.get(True, max(timeout, 0.001))
+        except Queue.Empty:
+            return ""
 
-    def run_remove_settings_commands(self):
+    def read_stdin(self):
+        for line in iter(sys.stdin.readline, ""):
+            self.queue.put(line.strip())
+        self.queue.put(None)
+
+    def accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            self.spawn(self.read_client, client)
+
+    def read_client(self, client):
+        with contextlib.closing(client.makefile("r")) as lines:
+            for line in lines:
+                self.queue.put(line.strip())
+        client.close()
+
+    def read_fifo(self):
+        while True:
+            # blocks until a writer opens the pipe; EOF when it closes it
+            with open(self.source) as fifo:
+                for line in iter(fifo.readline, ""):
+                    self.queue.put(line.strip())
+
+    def follow_file(self):
+        feed = open(self.source)
+        feed.seek(0, os.SEEK_END)
+        partial = ""
+        while True:
+            line = feed.readline()
+            if line.endswith("\n"):
+                self.queue.put((partial + line).strip())
+                partial = ""
+                continue
+            partial += line
+            time.sleep(self.poll_seconds)
+            try:
+                current = os.stat(self.source)
+            except OSError:
+                # being rotated; it will be back
+                continue
+            if (current.st_ino != os.fstat(feed.fileno()).st_ino or
+                    current.st_size < feed.tell()):
+                feed.close()
+                feed = open(self.source)
+                partial = ""
+
+    def close(self):
+        if self.listener is not None:
+            path = self.listener.getsockname()
+            self.listener.close()
+            if os.path.exists(path):
+                os.remove(path)
+
+# seconds per unit of a duration such as "12h"
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_duration(text):
+    """
+    Returns the seconds in a duration such as "90", "30m", "12h" or "7d".
+    Raises ValueError if it isn't one.
+    """
+    text = text.strip().lower()
+    unit = DURATION_UNITS.get(text[-1:])
+    if unit is not None:
+        text = text[:-1]
+    seconds = float(text) * (unit or 1)
+    if seconds <= 0:
+        raise ValueError("a duration must be positive")
+    return seconds
+
+class ExpiryScheduler(object):
+    """
+    Decides when expired addresses (see BatchGroup.ttl) are taken off their
+    devices. Expiries are kept in a heap, soonest first. A device's expired
+    addresses wait for each other: once the first of them has been due for
+    window seconds, all of the device's due ones are removed in one run, so
+    that thousands of addresses expiring within minutes of each other cost
+    one removal (and on SRX one commit) per device rather than one each.
+    Blocks are lifted up to window seconds late, never early.
+    """
+    # a removal that failed is tried again no sooner than this many seconds
+    # later (see retry)
+    retry_seconds = 60.0
+
+    def __init__(self, window=300.0):
+        self.window = window
+        # (expires, device, zone, name), soonest first
+        self.heap = []
+        # the latest expiry of every address scheduled; earlier ones left in
+        # the heap (or waiting) by a later add, or by discard, are skipped
+        self.latest = {}
+        # per device: the due (zone, name, expires) entries, and when the
+        # first was due
+        self.waiting = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.latest)
+
+    def add(self, expires, hostname, zone, name):
+        self.latest[(hostname, zone, name)] = expires
+        heapq.heappush(self.heap, (expires, hostname, zone, name))
+
+    def discard(self, hostname, zone, name):
         """
-        Runs the commands to remove the settings from the device.
+        Unschedules an address, e.g. one added again without a ttl.
+        """
+        self.latest.pop((hostname, zone, name), None)
+
+    def retry(self, now, hostname, names):
+        """
+        Schedules the (zone, name) pairs of hostname whose removal failed
+        again, to be removed a window (and at least retry_seconds) from now.
+        """
+        expires = now + max(0.0, self.retry_seconds - self.window)
+        for zone, name in names:
+            self.add(expires, hostname, zone, name)
+
+    def load(self, expiries):
+        """
+        Adds (expires, device, zone, name) tuples, such as those of
+        StateStore.expiries.
+        """
+        for expires, hostname, zone, name in expiries:
+            self.latest[(hostname, zone, name)] = expires
+            self.heap.append((expires, hostname, zone, name))
+        heapq.heapify(self.heap)
+
+    def wait(self, now):
+        """
+        Returns the seconds until due() has something to return, or None if
+        nothing is scheduled.
         """
-        commands = ("\nconfigure\n" + "\n".join(x for x in (self.delete_commands)) +
-                    "\ncommit check\n" + "commit\n" + "exit\n")
-        run_via_ssh_srx(self.delete_commands, self.hostname, self.ssh_user, self.ssh_pass)
+        times = [since + self.window for _, since in self.waiting.itervalues()]
+        if self.heap:
+            times.append(self.heap[0][0] + self.window)
+        if not times:
+            return None
+        return max(0.0, min(times) - now)
 
-def run_via_ssh_srx(commands, hostname, user, password):
+    def due(self, now):
+        """
+        Returns the expired addresses whose removal shouldn't wait any
+        longer, as (zone, name) lists by device, and forgets them.
+        """
+        while self.heap and self.heap[0][0] <= now:
+            expires, hostname, zone, name = heapq.heappop(self.heap)
+            if self.latest.get((hostname, zone, name)) != expires:
+                continue
+            if hostname not in self.waiting:
+                self.waiting[hostname] = ([], expires)
+            self.waiting[hostname][0].append((zone, name, expires))
+        ready = collections.OrderedDict()
+        for hostname, (entries, since) in self.waiting.items():
+            if since + self.window > now:
+                continue
+            del self.waiting[hostname]
+            names = []
+            for zone, name, expires in entries:
+                # unless added again or discarded while waiting
+                if self.latest.get((hostname, zone, name)) == expires:
+                    del self.latest[(hostname, zone, name)]
+                    names.append((zone, name))
+            if names:
+                ready[hostname] = names
+        return ready
+
+def record_expiries(batches):
     """
-    Runs a command on a juniper device using password authentication.
-    
-    The command argument can consist of multiple commands joined together by
-    newlines; in this case, each command is executed in the same shell session.
+    With the state store open, records when the addresses just added to the
+    device of every batch expire (see BatchGroup.record_expiry).
     """
-    #setup connection
-    s = paramiko.SSHClient()
-    s.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    try:
-        conn = s.connect(hostname, username=user, password=password, port=22)
+    if not STATE.is_open():
+        return
+    for batch in batches:
+        batch.record_expiry(batch.address_names())
 
-        channel = s.invoke_shell()
-        channel.settimeout(timeout=0.7)
-        channel.set_combine_stderr(True)
-        stdin = channel.makefile('wb')
-        stdout = channel.makefile('rb')
-        #Finish out the list of commands
-        commands.insert(0, 'configure') #enter config mode
-        commands.insert(1, 'rollback') #clear out any config changes to start clear - roll back to last committed config
-        commands.append('commit check') #verify pendign commit
-        commands.append('commit') #commit changes
-        commands.append('exit') #exit config mode
-        #Basic format that the command list should be in:
-        #commands = ['configure', 'rollback', 'set security zones security-zone detrust address-book address 1.1.6.10 1.1.6.10/32',
-        #            'commit check', 'commit', 'exit']
-        for command in commands:
-            #Must put a new line at the end of each command
-            stdin.write(command.rstrip() + '\n')
-            stdin.flush()
-            if command == 'commit' or command == 'commit check':
-                #Need to wait longer for this to happen so that response can be retrived
-                time.sleep(5)
-                #channel.recv_ready() #too fast
-            elif command == 'configure' or command == 'rollback':
-                #Takes some time, but not a ton
-                time.sleep(1)
-            else:
-                time.sleep(.05)
-                #print channel.recv_exit_status() #never returns
-            #Print out what the SRX machine is running and saying
-            try:
-                result=""
-                while not channel.closed:
-                    coutstring = channel.recv(1024)
-                    result += coutstring
-                    if len(coutstring) < 1024:
-                        break
-                print result
-            except:
-                print "Oh, no. I broke! Report a bug. Problem command: " + command
-            #This part below here should never actually print.
-            #It checks to make sure that nothing is left in the buffer
-            trouble=""
-            try:
-                while not channel.closed:
-                    coutstring = channel.recv(1024)
-                    trouble += coutstring
-                    if len(coutstring) < 1024:
-                        break
-                print ">>>>>>>"
-                print trouble
-                print "<<<<<<<"
-            except:
-                #TODO: Make this part better.
-                trouble += "Had trouble with " + command + ", please check."
-                #print trouble
-        #Sleep just to make sure it can finish commands
-        time.sleep(5)
-        channel.close()
-    except paramiko.AuthenticationException:
-        print "Authentication failed."
-    s.close()
-          
-def gen_srx_set_commands(ip_addrs, addr_group_descr, addr_description, group_limit, zone,
-        netmask):
+def run_expiries(batches, due, max_connections=8):
     """
-    Returns a list of "set" commands for SRX devices.
+    Removes the expired addresses in due ((zone, name) lists by device, see
+    ExpiryScheduler.due) from the devices of batches, one removal per
+    device (see BatchGroup.expiry_commands). Addresses no longer on their
+    device are only forgotten. Returns the results of run_batches, along
+    with one for every device that couldn't be read.
+    """
+    active = []
+    failed = []
+    for batch in batches:
+        names = set(name for zone, name in due.get(batch.hostname, ()) if zone == batch.zone)
+        if not names:
+            continue
+        try:
+            commands, gone = batch.expiry_commands(names)
+        except Exception as e:
+            failed.append({'hostname': batch.hostname, 'device_type': batch.device_type,
+                           'seconds': 0.0,
+                           'trouble': [("", "%s: %s" % (e.__class__.__name__, e))]})
+            continue
+        STATE.forget_expiries(batch.hostname, batch.zone, gone)
+        print (batch.hostname + ": " + str(len(names)) + " addresses expired, " +
+               str(len(commands)) + " commands to remove them")
+        if commands:
+            batch.remove_settings_commands = commands
+            active.append(batch)
+    results = failed + run_batches(active, "remove", max_connections)
+    if results:
+        print_run_summary(results)
+    return results
 
-    TODO: handling of netmasks (i.e., allow ranges of IPs to be
-    specified)
+class MicroBatcher(object):
     """
-    # the list to hold the commands
-    commands = []
+    Gathers the addresses of a live feed into micro-batches and pushes each
+    one to every device with the batches' own add commands, over the
+    sessions SESSIONS keeps open between pushes.
 
-    # formats the address set commands
-    # TODO: should we use "untrust" in place of "V1-Untrust" for the zones?
-    # I.e., should we translate from netscreen zones to "srx" zones? Is there
-    # even a difference in practice?
+    A micro-batch is pushed once batch_size lines are waiting, or once
+    batch_seconds have passed since the first of them came in. An SRX (without
+    commit_size) commits once per push, so a steady feed costs it at most
+    one commit every batch_seconds plus one per batch_size addresses, however
+    many alerts it's made of.
 
-    # figure out the necessary number of address groups
-    num_of_groups = math.floor((len(ip_addrs)-1)/group_limit)
-    count_ips = 1
-    # create multiple groups, if necessary, using group_limit
-    for ip in ip_addrs:
-        ip = ip.rstrip()
-        if num_of_groups > 0:
-            group_num = int(math.floor((count_ips-1)/group_limit)) + 1
-            multiple_groups = "_" + str(group_num)
+    Each device is read once at the start: addresses already on it are
+    skipped, and new ones go into the groups of the batch (or of the action,
+    with pack_groups) that still have room before new groups are opened, so
+    that pushing a few addresses at a time doesn't leave a trail of nearly
+    empty groups.
+
+    With expiry (an ExpiryScheduler), the addresses pushed with a ttl are
+    scheduled to expire, and expired ones are removed in between pushes.
+    """
+    def __init__(self, batches, batch_size=1000, batch_seconds=10.0, max_connections=8,
+            expiry=None):
+        self.batches = batches
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.max_connections = max_connections
+        self.expiry = expiry
+        # lines waiting to be pushed, and when the first of them came in
+        self.pending = []
+        self.since = None
+        # per device: the address names on it, and the members of its groups
+        self.known = {}
+        self.occupancy = {}
+
+    def refresh(self, batch):
+        """
+        Reads what's on the device of batch (see BatchGroup.live_index).
+        """
+        live = batch.live_index()
+        self.known[batch.hostname] = set(name for zone, name in live.addresses
+                                         if zone == batch.zone)
+        self.occupancy[batch.hostname] = dict(
+            (group, len(members)) for (zone, group), members in live.groups.iteritems()
+            if zone == batch.zone and batch.owns_group(group))
+
+    def add(self, line):
+        if not self.pending:
+            self.since = time.time()
+        self.pending.append(line)
+
+    def wait(self):
+        """
+        Returns the seconds until the pending lines are due, or None if there
+        are none.
+        """
+        if not self.pending:
+            return None
+        if len(self.pending) >= self.batch_size:
+            return 0
+        return self.since + self.batch_seconds - time.time()
+
+    def push(self):
+        """
+        Pushes the pending lines to every device that doesn't have them yet,
+        and returns the results of run_batches.
+        """
+        entries, rejects = ingest_addresses(self.pending)
+        self.pending = []
+        print_ingest_report(entries, rejects)
+        active = []
+        # per device, the names of every address pushed, new or not
+        seen = {}
+        # per device, what was known before this push, to go back to if it fails
+        before = {}
+        for batch in self.batches:
+            known = self.known[batch.hostname]
+            seen[batch.hostname] = set(address_parts(entry, batch.netmask)[0]
+                                       for entry in entries)
+            new = [entry for entry in entries
+                   if address_parts(entry, batch.netmask)[0] not in known]
+            if not new:
+                continue
+            occupancy = self.occupancy[batch.hostname]
+            before[batch.hostname] = (set(known), dict(occupancy))
+            batch.ip_addrs = new
+            batch.add_settings_commands = list(batch.packed_set_commands(new, occupancy))
+            # where the addresses go, to fill the same groups next time
+            group_base = batch.addr_group_prefix + "_" + batch.addr_description
+            for group, chunk in list(packed_groups(new, batch.group_limit, group_base,
+                                                   occupancy)):
+                occupancy[group] = occupancy.get(group, 0) + len(chunk)
+            known.update(address_parts(entry, batch.netmask)[0] for entry in new)
+            active.append(batch)
+        results = []
+        if active:
+            print ("Pushing " + str(len(entries)) + " addresses to " + str(len(active)) +
+                   " device(s)...")
+            results = run_batches(active, "add", self.max_connections)
+            print_run_summary(results)
         else:
-            multiple_groups = ""
-        address = ('set security zones security-zone '+zone+' address-book'
-            ' address '+ip+' '+ip+'/32')
-        address_set = ('set security zones security-zone '+zone+' address-book'
-            ' address-set '+addr_group_descr+'_'+addr_description+multiple_groups+' address '+ip)
-        commands.append(address)
-        commands.append(address_set)
-        count_ips += 1
-
-    # return the generated commands
-    return commands
+            print "Nothing new for any device"
+        if STATE.is_open():
+            # addresses the feed reports again start their ttl over, the
+            # same as in a run that adds them again
+            for batch in self.batches:
+                self.record_expiry(batch, seen[batch.hostname])
+        for batch, result in zip(active, results):
+            if result['trouble']:
+                # forget this push, so the addresses are sent again next time
+                # even if the device can't be read now
+                self.known[batch.hostname], self.occupancy[batch.hostname] = \
+                    before[batch.hostname]
+                # start again from what actually made it onto the device
+                try:
+                    self.refresh(batch)
+                except Exception as e:
+                    print batch.hostname + ": couldn't read the device again: " + str(e)
+        return results
 
-def gen_srx_delete_commands(ip_addrs, addr_group_descr, addr_description, group_limit, zone,
-        netmask):
+    def record_expiry(self, batch, names):
+        """
+        Records when the addresses names of batch expire (see
+        BatchGroup.record_expiry) and schedules them, or unschedules them
+        without a ttl.
+        """
+        expires = batch.record_expiry(names)
+        if self.expiry is None:
+            return
+        for name in names:
+            if expires is None:
+                self.expiry.discard(batch.hostname, batch.zone, name)
+            else:
+                self.expiry.add(expires, batch.hostname, batch.zone, name)
+
+    def expire(self):
+        """
+        Removes the expired addresses that are due (see ExpiryScheduler),
+        then reads those devices again. The addresses of a device whose
+        removal had trouble are tried again later, those of them still
+        recorded as expiring.
+        """
+        now = time.time()
+        due = self.expiry.due(now)
+        if not due:
+            return
+        results = run_expiries(self.batches, due, self.max_connections)
+        for result in results:
+            if not result['trouble']:
+                continue
+            hostname = result['hostname']
+            left = set((zone, name) for _, _, zone, name in STATE.expiries(hostname=hostname))
+            retry = [x for x in due[hostname] if x in left]
+            if retry:
+                print (hostname + ": trying to remove " + str(len(retry)) + " expired"
+                       " addresses again later")
+                self.expiry.retry(now, hostname, retry)
+        for batch in self.batches:
+            if batch.hostname not in due:
+                continue
+            try:
+                self.refresh(batch)
+            except Exception as e:
+                print batch.hostname + ": couldn't read the device again: " + str(e)
+        return results
+
+    def run(self, feed):
+        """
+        Reads feed (a FeedReader) and pushes micro-batches until it ends or
+        the user presses Ctrl-C, then pushes what's left.
+        """
+        for batch in self.batches:
+            self.refresh(batch)
+        print ("Waiting for addresses; pushing every " + str(self.batch_size) +
+               " or after " + str(self.batch_seconds) + " seconds")
+        try:
+            while True:
+                wait = self.wait()
+                if wait is not None and wait <= 0:
+                    self.push()
+                    continue
+                if self.expiry is not None:
+                    expiry_wait = self.expiry.wait(time.time())
+                    if expiry_wait is not None and expiry_wait <= 0:
+                        self.expire()
+                        continue
+                    if expiry_wait is not None and (wait is None or expiry_wait < wait):
+                        wait = expiry_wait
+                line = feed.get(self.batch_seconds if wait is None else wait)
+                if line is None:
+                    break
+                if line:
+                    self.add(line)
+        except KeyboardInterrupt:
+            print "Stopping..."
+        if self.pending:
+            self.push()
+
+def run_daemon(args, parser):
     """
-    Returns a list of "delete" commands for SRX devices.
+    Runs as a service (--daemon): pushes the addresses of a live feed to the
+    devices in micro-batches (see MicroBatcher) until the feed ends or the
+    user presses Ctrl-C, without asking for confirmation.
     """
-    # the list to hold the commands
-    commands = []
+    batches = make_batches([], args, parser)
+    ask_passwords(batches)
 
-    # formats the "unset" commands - multiple groups
-    num_of_groups = math.floor(len(ip_addrs)/group_limit)
-    count_ips = 1
-    
-    # formats the unset commands
-    # uses grou_limit as necessary
-    for ip in ip_addrs:
-        ip = ip.rstrip()
-        if num_of_groups > 0:
-            group_num = int(math.floor((count_ips-1)/group_limit)) + 1
-            multiple_groups = "_" + str(group_num)
-        else:
-            multiple_groups = ""
-        address = ('delete security zones security-zone '+zone+' address-book'
-            ' address ' +ip+' '+ip+'/32')
-        address_set = ('delete security zones security-zone '+zone+' address-book'
-            ' address-set '+addr_group_descr+'_'+addr_description+multiple_groups+' address '+ip)
-        commands.append(address_set)
-        commands.append(address)
-        count_ips += 1
-    
-    # return the list of commands
-    return commands
+    # stop the same way on "kill" as on Ctrl-C
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    expiry = None
+    if STATE.is_open():
+        expiry = ExpiryScheduler(parse_duration(args.expiry_window))
+        expiry.load(STATE.expiries())
+        print str(len(expiry)) + " addresses scheduled to expire"
+    feed = FeedReader(args.daemon)
+    feed.start()
+    try:
+        MicroBatcher(batches, int(args.batch_size), float(args.batch_seconds),
+                     int(args.max_connections), expiry).run(feed)
+    finally:
+        feed.close()
+        finish_run(args.metrics)
+
+def run_expire(args, parser):
+    """
+    Removes every address whose ttl has run out (--expire) from the devices,
+    one removal per device, without asking for confirmation, and exits.
+    """
+    batches = make_batches([], args, parser)
+    now = time.time()
+    expiry = ExpiryScheduler(window=0)
+    expiry.load(STATE.expiries(until=now))
+    due = expiry.due(now)
+    hostnames = set(batch.hostname for batch in batches)
+    count = sum(len(names) for hostname, names in due.iteritems() if hostname in hostnames)
+    print str(count) + " addresses have expired on " + str(len(batches)) + " device(s)"
+    if count:
+        ask_passwords([batch for batch in batches if batch.hostname in due])
+        run_expiries(batches, due, int(args.max_connections))
+    finish_run(args.metrics)
 
 def main():
     """
@@ -507,7 +3829,8 @@ def main():
                         ' Deny_addr'), default="Deny_addr",
                         metavar='--action-description')
     parser.add_argument('-p', '--path', help=('A path to a file containing one'
-                        ' IP address per line.'), required=True)
+                        ' IP address per line. Required except with --find and'
+                        ' --daemon.'))
     parser.add_argument('-z', '--zone', help=('The origin zone for the firewall'
                         ' rule. Default: "V1-Untrust"'), default="V1-Untrust")
     parser.add_argument('-n', '--netmask', help=('The netmask to be used for'
@@ -515,63 +3838,232 @@ def main():
                         default="255.255.255.255")
 #    parser.add_argument('--results', help=('Display the results of each'
 #                        ' command sequence.'))
-    parser.add_argument('-t', '--device_type', help=('The device type. The only'
-                        ' currently supported types are `ssg` and `srx`. Default:'
-                        ' ssg'), default="ssg", metavar='device-type')
+    parser.add_argument('-t', '--device_type', help=('The device type: `ssg`, `srx` or'
+                        ' one added with --driver. Default: ssg'), default="ssg",
+                        metavar='device-type')
     parser.add_argument('-g', '--group_limit', help=('The number of addresses per address'
                         ' group. Default: 256'), default="256", metavar='group-limit')
     parser.add_argument('-u', '--user', help=('The username to use when'
                         ' connecting to the firewall device.')) 
+    parser.add_argument('-w', '--window', help=('SSG only: the number of commands to'
+                        ' send ahead without waiting for the device to answer.'
+                        ' Default: 1'), default="1", metavar='window')
+    parser.add_argument('--sessions', help=('SSG only: open up to this many SSH'
+                        ' sessions to each device and spread the commands over them:'
+                        ' the addresses first, then the groups. Default: 1'),
+                        default="1", metavar='n')
+    parser.add_argument('-b', '--bulk_load', help=('Transfer the commands to the device'
+                        ' as one file and apply them in one step (SFTP and "load set"'
+                        ' on SRX, TFTP and a config merge on SSG) instead of typing'
+                        ' them one at a time.'), action='store_true')
+    parser.add_argument('--aggregate', help=('Merge the addresses into the fewest'
+                        ' prefixes that cover them before generating commands.'),
+                        action='store_true')
+    parser.add_argument('--overcoverage', help=('With --aggregate, the fraction of a'
+                        ' merged prefix that may be addresses not in the file.'
+                        ' Default: 0'), default="0", metavar='fraction')
+    parser.add_argument('--commit_size', help=('SRX only: commit every this many'
+                        ' addresses instead of once at the end.'), metavar='commit-size')
+    parser.add_argument('--adaptive_commit', help=('SRX only: with --commit_size, tune'
+                        ' the number of addresses per commit for the fastest push.'),
+                        action='store_true')
+    parser.add_argument('--confirm_minutes', help=('SRX only: with --commit_size, use'
+                        ' "commit confirmed" so the device rolls back the last chunk'
+                        ' by itself if the push dies.'), metavar='minutes')
+    parser.add_argument('--coalesce', help=('SRX only: put up to this many addresses'
+                        ' in each address-set command, as a [ ... ] list, instead of'
+                        ' one command per address.'), metavar='n')
+    parser.add_argument('-s', '--sync', help=('Read the address book from the device'
+                        ' first and only send the commands for what is missing.'),
+                        action='store_true')
+    parser.add_argument('--remove_stale', help=('With --sync, also remove addresses'
+                        ' that are in this batch\'s groups on the device but not in'
+                        ' the file.'), action='store_true')
+    parser.add_argument('--pack_groups', help=('Top up the groups of this action'
+                        ' (any with the action description\'s prefix) that have room'
+                        ' before opening new ones, and remove addresses from whichever'
+                        ' of them they are in. Reads each device first.'),
+                        action='store_true')
+    parser.add_argument('--compact', help=('With --pack_groups, after removing, empty'
+                        ' the groups of this action that are at most this fraction full'
+                        ' into the others.'), metavar='fraction')
+    parser.add_argument('-i', '--inventory', help=('A path to a file listing the devices'
+                        ' to run the generated commands on, one "hostname [device-type]'
+                        ' [user]" per line; a device listed twice is only pushed to once.'
+                        ' Replaces device-address.'))
+    parser.add_argument('-c', '--max_connections', help=('The number of devices to'
+                        ' connect to (or, with --compile, write files for) at the'
+                        ' same time. Default: 8'), default="8",
+                        metavar='max-connections')
+    parser.add_argument('--driver', help=('Import this Python module first, e.g. to'
+                        ' register more device types (see register_driver). Can be'
+                        ' given more than once.'), action='append', default=[],
+                        metavar='MODULE')
+    parser.add_argument('--compile', help=('Don\'t connect to anything: write the add'
+                        ' and remove commands of every device to DIR/<hostname>.add.txt'
+                        ' and DIR/<hostname>.remove.txt and exit.'), metavar='DIR')
+    parser.add_argument('--port', help=('The SSH port of the devices. Default: 22'),
+                        default="22", metavar='port')
+    parser.add_argument('--session_log', help=('Also write everything the devices print'
+                        ' to this gzip-compressed file (appended to if it exists).'),
+                        metavar='PATH')
+    parser.add_argument('--read_size', help=('The most bytes to read from a device at'
+                        ' once. Default: 32768'), default="32768", metavar='bytes')
+    parser.add_argument('--metrics', help=('Write the timings, byte counts and timeouts'
+                        ' of the run to PREFIX.json and PREFIX.prom (Prometheus text'
+                        ' format) at the end.'), metavar='PREFIX')
+    parser.add_argument('--state', help=('A SQLite file recording what was pushed to'
+                        ' which device and group. Removals and --sync then work from it'
+                        ' instead of the input file and the device configuration.'),
+                        metavar='PATH')
+    parser.add_argument('--journal', help=('Record how far every push got in a'
+                        ' journal in DIR, so that running the same commands again after'
+                        ' an interrupted push carries on where it stopped instead of'
+                        ' starting over.'), metavar='DIR')
+    parser.add_argument('--cache', help=('A SQLite file keeping a parsed copy of each'
+                        ' device\'s address book. A device\'s configuration is then only'
+                        ' downloaded again once its checksum (SSG) or commit history'
+                        ' (SRX) shows it changed.'), metavar='PATH')
+    parser.add_argument('--find', help=('With --state, list the devices, zones and'
+                        ' groups that have an address object covering this IP, and'
+                        ' exit.'), metavar='IP')
+    parser.add_argument('--daemon', help=('Keep running and push the addresses that'
+                        ' arrive on SOURCE in micro-batches instead of reading -p:'
+                        ' "-" for standard in, "unix:PATH" for a Unix socket, or the'
+                        ' path of a named pipe or of a file to follow.'),
+                        metavar='SOURCE')
+    parser.add_argument('--batch_size', help=('With --daemon, push once this many'
+                        ' addresses are waiting. Default: 1000'), default="1000",
+                        metavar='n')
+    parser.add_argument('--batch_seconds', help=('With --daemon, push at the latest this'
+                        ' many seconds after the first waiting address came in.'
+                        ' Default: 10'), default="10", metavar='seconds')
+    parser.add_argument('--ttl', help=('With --state, have the added addresses expire'
+                        ' after DURATION (seconds, or e.g. 30m, 12h, 7d): --expire or'
+                        ' --daemon then removes them.'), metavar='DURATION')
+    parser.add_argument('--expire', help=('With --state, remove the addresses whose'
+                        ' --ttl has run out from the devices, without asking, and exit.'),
+                        action='store_true')
+    parser.add_argument('--expiry_window', help=('With --daemon, wait until the first'
+                        ' expired address of a device has been due this long, then'
+                        ' remove all of its expired ones at once. Default: 5m'),
+                        default="5m", metavar='DURATION')
     parser.add_argument('device_address', help=('The address or hostname of the'
                         ' device to run the generated commands on.'),
-                        metavar='device-address')
+                        metavar='device-address', nargs='?')
     args = parser.parse_args()
+    for module in args.driver:
+        importlib.import_module(module)
+    ChannelReader.read_size = int(args.read_size)
+    if args.session_log:
+        OUTPUT.open_log(args.session_log)
+    if args.state:
+        STATE.open(args.state)
+    if args.cache:
+        CACHE.open(args.cache)
+
+    if args.find:
+        if not args.state:
+            parser.error("--find needs --state")
+        print_found(args.find, STATE.find(args.find))
+        finish_run()
+        return
+    if args.ttl:
+        if not args.state:
+            parser.error("--ttl needs --state")
+        try:
+            parse_duration(args.ttl)
+        except ValueError:
+            parser.error("--ttl: not a duration: " + args.ttl)
+    try:
+        parse_duration(args.expiry_window)
+    except ValueError:
+        parser.error("--expiry_window: not a duration: " + args.expiry_window)
+    if args.confirm_minutes and not args.commit_size:
+        # with a single commit there's no later one to confirm it
+        parser.error("--confirm_minutes needs --commit_size")
+    if args.expire:
+        if not args.state:
+            parser.error("--expire needs --state")
+        run_expire(args, parser)
+        return
+    if args.daemon:
+        run_daemon(args, parser)
+        return
+    if not args.path:
+        parser.error("argument -p/--path is required")
+    if args.pack_groups and args.remove_stale:
+        parser.error("--remove_stale can't be used with --pack_groups")
+    if args.compact and not args.pack_groups:
+        parser.error("--compact needs --pack_groups")
+    if args.compile and (args.sync or args.pack_groups or args.state):
+        parser.error("--compile can't be used with --sync, --pack_groups or --state,"
+                     " which need to read the devices")
+
+    # IP addresses must be provided in a text file, since standard in is
+    # needed for the user interaction prompts. They are checked, sorted and
+    # deduplicated before anything else, so that bad lines never become
+    # commands the device has to reject.
+    ip_addresses, rejects = ingest_addresses(InputFile(args.path))
+    print_ingest_report(ip_addresses, rejects)
+
+    if args.aggregate:
+        count = len(ip_addresses)
+        ip_addresses = aggregate_addresses(ip_addresses, args.netmask,
+                                           float(args.overcoverage))
+        print "Aggregated " + str(count) + " entries into " + str(len(ip_addresses))
 
-    # get input from standard in by default
-    # TODO: since adding user interaction prompts, this is broken.
-    # IP addresses must be provided in a text file.
-    input = sys.stdin
-
-    # if we are supplied with the name of an input file on the command line,
-    # use that for input instead of standard in.
-    if args.path:
-        input = open(args.path)
-
-    # load the IP addresses from the input
-    ip_addresses = []
-    for line in input:
-        ip_addresses.append(line.rstrip())
-
-    # determine which type of batch we should use
-    batch = None
-    if args.device_type == "ssg":
-        batch = SSG(ip_addrs=ip_addresses, netmask=args.netmask,
-                    addr_description=args.description,
-                    addr_group_prefix=args.action_description, zone=args.zone,
-                    group_limit=int(args.group_limit), hostname=args.device_address,
-                    ssh_user=args.user)
-    elif args.device_type == "srx":
-        batch = SRX(ip_addrs=ip_addresses, netmask=args.netmask,
-                    addr_description=args.description,
-                    addr_group_prefix=args.action_description, zone=args.zone,
-                    group_limit=int(args.group_limit), hostname=args.device_address,
-                    ssh_user=args.user)
+    batches = make_batches(ip_addresses, args, parser)
+    if args.compile:
+        count = compile_batches(batches, args.compile, int(args.max_connections))
+        print "Wrote " + str(count) + " files to " + args.compile
+        finish_run(args.metrics)
+        return
+    if len(batches) == 1:
+        target = batches[0].hostname
     else:
-        raise Exception("Device type not recognized")
+        target = str(len(batches)) + " devices"
+
+    if args.sync:
+        for batch in batches:
+            batch.remove_stale = args.remove_stale
+        user_input = raw_input("\nSync the addresses in "+args.path+" to "+target+" ? (y/N) ")
+        if user_input == "y" or user_input == "Y":
+            ask_passwords(batches)
+            print "Syncing settings to device..."
+            print_run_summary(run_batches(batches, "sync", int(args.max_connections)))
+            record_expiries(batches)
+        finish_run(args.metrics)
+        return
+
+    # the commands only differ by device type, so print them once per type
+    examples = collections.OrderedDict()
+    for batch in batches:
+        examples.setdefault(batch.__class__, batch)
 
     print """
     ADD SETTINGS COMMANDS
     """
     # print the commands to add the settings to the device
-    batch.print_add_settings_commands()
+    if args.pack_groups:
+        # which groups have room differs from device to device
+        ask_passwords(batches)
+        for batch in batches:
+            batch.add_settings_commands = batch.packed_add_commands(batch.live_index())
+            print batch.hostname + ":"
+            batch.print_add_settings_commands()
+    else:
+        for batch in examples.values():
+            batch.print_add_settings_commands()
 
     # prompt the user for final approval before running the commands
-    user_input = raw_input("\nRun these set commands on "+args.device_address+" ? (y/N) ")
+    user_input = raw_input("\nRun these set commands on "+target+" ? (y/N) ")
     if user_input == "y" or user_input == "Y":
         # run the commands
-        batch.ssh_pass = getpass.getpass("Enter password for user '"+args.user+"': ")
+        ask_passwords(batches)
         print "Running commands to add settings to device..."
-        batch.run_add_settings_commands()
+        print_run_summary(run_batches(batches, "add", int(args.max_connections)))
+        record_expiries(batches)
 
 #    if args.results:
 #        print """
@@ -585,16 +4077,33 @@ def main():
     """
 
     # print the commands to remove the settings from the device
-    batch.print_remove_settings_commands()
+    if args.state or args.pack_groups:
+        # what to remove from each device depends on what went where
+        ask_passwords(batches)
+        for batch in batches:
+            batch.remove_settings_commands = batch.planned_remove_commands()
+            print batch.hostname + ":"
+            batch.print_remove_settings_commands()
+    else:
+        for batch in examples.values():
+            batch.print_remove_settings_commands()
 
     # prompt the user for final approval before running the commands 
-    user_input = raw_input("\nRun these unset commands on "+args.device_address+" ? (y/N) ")
+    user_input = raw_input("\nRun these unset commands on "+target+" ? (y/N) ")
     if user_input == "y" or user_input == "Y":
-        if batch.ssh_pass is None:
-            batch.ssh_pass = getpass.getpass("Enter password for user '"+args.user+"': ")
+        ask_passwords(batches)
         print "Running commands to remove settings from device..."
-        batch.run_remove_settings_commands()
+        print_run_summary(run_batches(batches, "remove", int(args.max_connections)))
+
+    finish_run(args.metrics)
 
 # launches the main function if the script is being executed directly
 if __name__ == '__main__':
-    main()
+    # modules loaded with --driver import this script by name; give them this
+    # copy, the one whose DRIVERS main() uses, instead of a second one
+    sys.modules.setdefault("bulk_IP_add_automated", sys.modules[__name__])
+    try:
+        main()
+    finally:
+        SESSIONS.close()
+        OUTPUT.close()
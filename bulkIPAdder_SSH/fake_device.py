@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+"""
+A stand-in for a Juniper SSG (ScreenOS) or SRX (Junos) firewall, for trying
+bulk_IP_add_automated.py out and benchmarking it without real hardware.
+
+It's a small paramiko SSH server on localhost that accepts any user (and any
+password, unless it's given one) and emulates what the script relies on:
+    - the prompts, and the echo of every command
+    - an error for commands it doesn't know or is told to reject
+    - "get config", paged with "--- more ---", and "get checksum" (SSG)
+    - configuration mode, "commit" and "rollback" (SRX)
+    - "show configuration ... | display set" and "show system commit" (SRX)
+    - "load set" of a file uploaded over SFTP (SRX)
+    - "save config from tftp" (SSG)
+Every command can be made to take a fixed time, and commits another.
+
+It counts the commands and bytes it receives and sends, and keeps how long
+each command took from arriving to being answered, so that throughput and
+latency can be worked out afterwards (see benchmark.py).
+
+NOTE: written for Python 2.x, NOT 3.x
+"""
+
+import collections
+import os
+import re
+import socket
+import StringIO
+import struct
+import threading
+import time
+import zlib
+
+import paramiko
+
+# shared by every fake device; making a key takes a moment
+HOST_KEY = None
+HOST_KEY_LOCK = threading.Lock()
+
+def host_key():
+    """
+    Returns the host key of the fake devices, making it the first time.
+    """
+    global HOST_KEY
+    with HOST_KEY_LOCK:
+        if HOST_KEY is None:
+            HOST_KEY = paramiko.RSAKey.generate(2048)
+        return HOST_KEY
+
+# what a command is told when the device doesn't take it
+SCREENOS_REJECT = "                ^-------unknown keyword %s\r\n"
+JUNOS_REJECT = "                ^\r\nsyntax error.\r\n"
+# how ScreenOS pauses long output until a key is pressed
+SCREENOS_MORE = " --- more --- "
+# ends of line; ScreenOS clients send a carriage return, Junos ones a newline
+END_OF_LINE = re.compile(r'\r\n|\r|\n')
+
+class Config(object):
+    """
+    The configuration of a device as an ordered set of "set" lines, the way
+    both ScreenOS ("get config") and Junos ("display set") print it. Safe to
+    use from several sessions at once.
+    """
+    def __init__(self, lines=()):
+        self.lines = collections.OrderedDict((line, None) for line in lines)
+        self.lock = threading.RLock()
+
+    def apply(self, command):
+        """
+        Applies one "set", "unset" or "delete" command. Removing a statement
+        removes everything under it too. A Junos "[ a b c ]" list applies
+        the statement to each value.
+        """
+        with self.lock:
+            if command.endswith(" ]") and " [ " in command:
+                head, _, values = command[:-2].partition(" [ ")
+                for value in values.split():
+                    self.apply(head + " " + value)
+            else:
+                self.apply_one(command)
+
+    def apply_one(self, command):
+        verb, _, rest = command.partition(" ")
+        if verb == "set":
+            self.lines[command] = None
+            return
+        # ScreenOS takes an address out of a group with "remove" where it put
+        # it in with "add", and all of them with "clear"
+        if rest.endswith('" clear'):
+            rest = rest[:-len(" clear")] + " add"
+        target = "set " + rest.replace('" remove "', '" add "')
+        if target in self.lines:
+            del self.lines[target]
+            return
+        target += " "
+        for line in [x for x in self.lines if x.startswith(target)]:
+            del self.lines[line]
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.lines))
+
+    def __len__(self):
+        return len(self.lines)
+
+class FakeDevice(object):
+    """
+    One fake device, listening on a port of its own on localhost from the
+    moment it's made until close(). kind is "ssg" or "srx".
+
+    latency is the time every command takes and commit_latency the time every
+    SRX commit takes on top of it, both in seconds. With cli_sessions, only
+    that many commands are worked on at once, whatever the number of
+    sessions, like a device whose CLI is the bottleneck. Commands matching the
+    regular expression reject get an error instead of being applied. config
+    is the "set" lines the device starts with.
+    """
+    def __init__(self, kind="ssg", latency=0.0, commit_latency=0.0, reject=None,
+            config=(), password=None, hostname=None, page_length=20, tftp_port=69,
+            address="127.0.0.1", port=0, cli_sessions=None):
+        if kind not in ("ssg", "srx"):
+            raise ValueError("kind must be ssg or srx, not " + repr(kind))
+        self.kind = kind
+        self.latency = latency
+        self.commit_latency = commit_latency
+        self.cli = threading.Semaphore(cli_sessions) if cli_sessions else None
+        self.reject = re.compile(reject) if reject else None
+        self.config = Config(config)
+        self.password = password
+        self.hostname = hostname or kind + "-fake"
+        # lines of "get config" per page; 0 for no paging
+        self.page_length = page_length
+        # where "save config from tftp" fetches from; ScreenOS always uses 69
+        self.tftp_port = tftp_port
+        # files uploaded over SFTP, by path
+        self.files = {}
+        # everything the device was sent, in order
+        self.commands = []
+        # seconds from each command arriving to the device answering it
+        self.latencies = []
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        # when the configuration was committed (SRX), the latest first
+        self.commits = [time.time()]
+        # the changes not committed yet (SRX); shared by every session, like
+        # "configure" on Junos, so they outlive a dropped connection
+        self.candidate = []
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((address, port))
+        self.sock.listen(50)
+        self.address, self.port = self.sock.getsockname()
+        self.transports = []
+        self.closed = False
+        self.listener = threading.Thread(target=self.accept)
+        self.listener.daemon = True
+        self.listener.start()
+
+    def accept(self):
+        """
+        Starts an SSH server on every connection made to the device.
+        """
+        while not self.closed:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                break
+            with self.lock:
+                self.connections += 1
+            tport = paramiko.Transport(client)
+            tport.add_server_key(host_key())
+            tport.set_subsystem_handler("sftp", paramiko.SFTPServer, MemorySFTP)
+            tport.start_server(server=DeviceServer(self))
+            self.transports.append(tport)
+
+    def close(self):
+        """
+        Stops listening and drops every connection.
+        """
+        self.closed = True
+        # closing alone leaves accept() blocked and the port bound
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.listener.join(5)
+        for tport in self.transports:
+            tport.close()
+
+    def count(self, received=0, sent=0):
+        with self.lock:
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def rejects(self, command):
+        return self.reject is not None and self.reject.search(command) is not None
+
+class DeviceServer(paramiko.ServerInterface):
+    """
+    What the fake device allows over SSH: password logins, shells (with or
+    without a terminal), single commands and SFTP.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.user = None
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        if self.device.password is not None and password != self.device.password:
+            return paramiko.AUTH_FAILED
+        self.user = username
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth,
+            pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        shell = Shell(self.device, channel, self.user)
+        thread = threading.Thread(target=shell.run)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        shell = Shell(self.device, channel, self.user)
+        thread = threading.Thread(target=shell.run_one, args=(command,))
+        thread.daemon = True
+        thread.start()
+        return True
+
+class Shell(object):
+    """
+    One CLI session on the fake device.
+    """
+    def __init__(self, device, channel, user):
+        self.device = device
+        self.channel = channel
+        self.user = user or "root"
+        # SRX configuration mode
+        self.configuring = False
+        # the rest of a paged output, waiting for a key
+        self.held = None
+        # a carriage return ended the last line; skip a newline right after it
+        self.skip_newline = False
+
+    def send(self, text):
+        self.channel.sendall(text)
+        self.device.count(sent=len(text))
+
+    def prompt(self):
+        if self.device.kind == "ssg":
+            return self.device.hostname + "-> "
+        if self.configuring:
+            return "\r\n[edit]\r\n" + self.user + "@" + self.device.hostname + "# "
+        return self.user + "@" + self.device.hostname + "> "
+
+    def run(self):
+        """
+        Reads commands one line at a time and answers each one with its
+        echo, its output and the next prompt, until the client goes away.
+        """
+        try:
+            self.converse()
+        except (EOFError, socket.error, paramiko.SSHException):
+            # the client or its transport went away in the middle of an answer
+            pass
+        self.hang_up()
+
+    def hang_up(self):
+        """
+        Closes the channel, which may already be gone with its transport.
+        """
+        try:
+            self.channel.close()
+        except (EOFError, socket.error, paramiko.SSHException):
+            pass
+
+    def converse(self):
+        self.send("--- " + self.device.kind.upper() + " stand-in ---\r\n" + self.prompt())
+        buf = ""
+        while True:
+            data = self.channel.recv(4096)
+            if not data:
+                break
+            received = time.time()
+            self.device.count(received=len(data))
+            if self.skip_newline and data.startswith("\n"):
+                data = data[1:]
+            self.skip_newline = False
+            # while output is paused, every key shows the next page
+            while self.held is not None and data:
+                key, data = data[0], data[1:]
+                self.more(key)
+            buf += data
+            while self.held is None:
+                match = END_OF_LINE.search(buf)
+                if match is None:
+                    break
+                line, buf = buf[:match.start()], buf[match.end():]
+                if match.group() == "\r" and not buf:
+                    self.skip_newline = True
+                if not self.answer(line, received):
+                    return
+
+    def run_one(self, command):
+        """
+        Runs a single command sent with exec instead of in a shell.
+        """
+        output = self.handle(command.strip())
+        try:
+            self.send((output or "").replace("\r\n", "\n"))
+            self.channel.send_exit_status(0)
+        except (EOFError, socket.error, paramiko.SSHException):
+            pass
+        self.hang_up()
+
+    def answer(self, line, received):
+        """
+        Runs one command and prints the echo, the output and the prompt.
+        Returns False if the command ended the session.
+        """
+        command = line.strip()
+        self.device.commands.append(command)
+        output = self.handle(command)
+        if output is None:
+            self.device.latencies.append(time.time() - received)
+            return False
+        output = line + "\r\n" + output
+        lines = output.split("\r\n")
+        page = self.device.page_length
+        if self.device.kind == "ssg" and page and len(lines) > page + 1:
+            self.held = lines[page:]
+            self.send("\r\n".join(lines[:page]) + "\r\n" + SCREENOS_MORE)
+        else:
+            self.send(output + self.prompt())
+        self.device.latencies.append(time.time() - received)
+        return True
+
+    def more(self, key):
+        """
+        Shows the next page of held output, or drops the rest on "q".
+        """
+        erase = "\x08" * len(SCREENOS_MORE)
+        if key == "q":
+            self.held = None
+            self.send(erase + "\r\n" + self.prompt())
+            return
+        page = self.device.page_length
+        lines, self.held = self.held[:page], self.held[page:]
+        if self.held:
+            self.send(erase + "\r\n".join(lines) + "\r\n" + SCREENOS_MORE)
+        else:
+            self.held = None
+            self.send(erase + "\r\n".join(lines) + self.prompt())
+
+    def handle(self, command):
+        """
+        Returns the output of one command, each line ending in "\r\n", or
+        None if it ends the session.
+        """
+        if not command:
+            return ""
+        if self.device.cli is None:
+            return self.handle_command(command)
+        with self.device.cli:
+            return self.handle_command(command)
+
+    def handle_command(self, command):
+        time.sleep(self.device.latency)
+        if self.device.kind == "ssg":
+            return self.handle_screenos(command)
+        return self.handle_junos(command)
+
+    def handle_screenos(self, command):
+        device = self.device
+        verb = command.split()[0]
+        if command in ("exit", "quit"):
+            return None
+        if device.rejects(command) or verb not in ("set", "unset", "get", "save"):
+            return SCREENOS_REJECT % verb
+        if command == "get config":
+            return "".join(line + "\r\n" for line in device.config)
+        if command == "get checksum":
+            checksum = zlib.crc32("\n".join(device.config)) & 0xffffffff
+            return "configuration checksum: %08x\r\n" % checksum
+        words = command.split()
+        if words[:4] == ["save", "config", "from", "tftp"] and len(words) >= 6:
+            data = tftp_get(words[4], words[5], device.tftp_port)
+            device.count(received=len(data))
+            failed = []
+            for line in data.splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                if device.rejects(line):
+                    failed.append(line)
+                else:
+                    device.config.apply(line)
+            return ("Load config from tftp server " + words[4] + " ...\r\n" +
+                    "".join("Failed command - " + x + "\r\n" for x in failed) + "Done\r\n")
+        if verb in ("set", "unset"):
+            device.config.apply(command)
+            return ""
+        return SCREENOS_REJECT % words[1]
+
+    def handle_junos(self, command):
+        device = self.device
+        words = command.split()
+        if not self.configuring:
+            if command in ("exit", "quit"):
+                return None
+            if command == "configure":
+                self.configuring = True
+                return "Entering configuration mode\r\n"
+            if words[:2] == ["show", "configuration"] and not device.rejects(command):
+                return self.show_configuration(command[len("show configuration"):])
+            if words[:3] == ["show", "system", "commit"]:
+                return self.show_commits()
+            return "                ^\r\nunknown command.\r\n"
+        if device.rejects(command):
+            return JUNOS_REJECT
+        if words[0] in ("set", "delete"):
+            device.candidate.append(command)
+            return ""
+        if words[0] == "rollback":
+            device.candidate = []
+            return "load complete\r\n"
+        if command == "show | compare":
+            return "".join("+  " + change + "\r\n" for change in device.candidate)
+        if words[0] == "commit":
+            time.sleep(device.commit_latency)
+            if words[1:2] == ["check"]:
+                return "configuration check succeeds\r\n"
+            with device.lock:
+                for change in device.candidate:
+                    device.config.apply(change)
+                device.commits.insert(0, time.time())
+                device.candidate = []
+            if words[1:2] == ["confirmed"]:
+                minutes = words[2] if len(words) > 2 else "10"
+                return ("commit confirmed will be automatically rolled back in " + minutes +
+                        " minutes unless confirmed\r\ncommit complete\r\n")
+            return "commit complete\r\n"
+        if words[:2] == ["load", "set"] and len(words) == 3:
+            data = device.files.get(words[2])
+            if data is None:
+                return "error: could not open configuration file: " + words[2] + "\r\n"
+            errors = 0
+            for line in data.splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                if device.rejects(line) or line.split()[0] not in ("set", "delete"):
+                    errors += 1
+                else:
+                    device.candidate.append(line)
+            if errors:
+                return "load complete (" + str(errors) + " errors)\r\n"
+            return "load complete\r\n"
+        if words[0] == "run" and words[1:3] == ["show", "configuration"]:
+            return self.show_configuration(command[len("run show configuration"):])
+        if command in ("exit", "quit", "exit configuration-mode"):
+            self.configuring = False
+            return "Exiting configuration mode\r\n\r\n"
+        return JUNOS_REJECT
+
+    def show_commits(self):
+        """
+        The commit history, the latest (number 0) first.
+        """
+        return "".join("%-4d%s by root via cli\r\n" % (number, time.strftime(
+                           "%Y-%m-%d %H:%M:%S UTC", time.gmtime(when)))
+                       for number, when in enumerate(self.device.commits))
+
+    def show_configuration(self, rest):
+        """
+        The committed configuration under a hierarchy, in "display set" form
+        whatever the pipes say.
+        """
+        path = rest.split("|")[0].strip()
+        prefix = "set " + path + " " if path else "set "
+        return "".join(line + "\r\n" for line in self.device.config if line.startswith(prefix))
+
+class MemoryFile(paramiko.SFTPHandle):
+    """
+    A file being uploaded to or read from the fake device over SFTP.
+    """
+    def __init__(self, device, path, data=None):
+        paramiko.SFTPHandle.__init__(self)
+        self.device = device
+        self.path = path
+        if data is None:
+            self.writefile = StringIO.StringIO()
+        else:
+            self.readfile = StringIO.StringIO(data)
+
+    def close(self):
+        if getattr(self, "writefile", None) is not None:
+            data = self.writefile.getvalue()
+            self.device.files[self.path] = data
+            self.device.count(received=len(data))
+        return paramiko.SFTP_OK
+
+class MemorySFTP(paramiko.SFTPServerInterface):
+    """
+    SFTP on the fake device, keeping the files in memory.
+    """
+    def __init__(self, server, *args, **kwargs):
+        paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+        self.device = server.device
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR | os.O_CREAT):
+            return MemoryFile(self.device, path)
+        if path not in self.device.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        return MemoryFile(self.device, path, self.device.files[path])
+
+    def remove(self, path):
+        if self.device.files.pop(path, None) is None:
+            return paramiko.SFTP_NO_SUCH_FILE
+        return paramiko.SFTP_OK
+
+    def stat(self, path):
+        if path not in self.device.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        attr = paramiko.SFTPAttributes()
+        attr.st_size = len(self.device.files[path])
+        attr.st_mode = 0100644
+        return attr
+
+    lstat = stat
+
+def tftp_get(host, filename, port=69, timeout=5):
+    """
+    Fetches a file from a TFTP server (RFC 1350, octet mode), the way an SSG
+    fetches a configuration to merge.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        sock.sendto(struct.pack("!H", 1) + filename + "\0octet\0", (host, port))
+        data = []
+        expected = 1
+        while True:
+            packet, server = sock.recvfrom(4 + 512)
+            opcode, block = struct.unpack("!HH", packet[:4])
+            if opcode == 5:
+                raise IOError("TFTP error " + str(block) + ": " + packet[4:].rstrip("\0"))
+            if opcode != 3:
+                continue
+            if block == expected:
+                data.append(packet[4:])
+                expected = (expected + 1) % 65536
+            sock.sendto(struct.pack("!HH", 4, block), server)
+            if block == (expected - 1) % 65536 and len(packet) - 4 < 512:
+                return "".join(data)
+    finally:
+        sock.close()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Runs a fake SSG or SRX device on localhost"
+            " to point bulk_IP_add_automated.py at.")
+    parser.add_argument('kind', choices=["ssg", "srx"], help="The kind of device to emulate.")
+    parser.add_argument('-p', '--port', metavar='port', default=2222, type=int,
+            help="The port to listen on. Default: 2222")
+    parser.add_argument('-l', '--latency', metavar='ms', default=0.0, type=float,
+            help="The time every command takes, in milliseconds. Default: 0")
+    parser.add_argument('--commit_latency', metavar='seconds', default=0.0, type=float,
+            help="The time every commit takes on SRX, in seconds. Default: 0")
+    parser.add_argument('--reject', metavar='regex',
+            help="Answer commands matching this with an error.")
+    parser.add_argument('--cli_sessions', metavar='n', type=int,
+            help="Work on at most this many commands at once, whatever the number of"
+                 " sessions. Default: no limit")
+    args = parser.parse_args()
+    device = FakeDevice(args.kind, args.latency / 1000.0, args.commit_latency, args.reject,
+                        port=args.port, cli_sessions=args.cli_sessions)
+    print "Fake " + args.kind.upper() + " listening on " + device.address + ":" + str(device.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print str(len(device.commands)) + " commands, " + str(len(device.config)) + " config lines"
+        device.close()
+
+if __name__ == '__main__':
+    main()
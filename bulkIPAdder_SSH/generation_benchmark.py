@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Measures how fast, and in how much memory, bulk_IP_add_automated.py turns
+input into commands, without any device: the parts of a run that grow with
+the number of addresses.
+
+For every batch size, each of these cases runs in a child process of its
+own, so that its peak memory is its own:
+    ingest        ingest_addresses on an input file of that many addresses,
+                  in shuffled order, the way main() reads --path
+    ssg_set       gen_ssg_set_commands, every command generated
+    ssg_unset     gen_ssg_unset_commands
+    srx_set       gen_srx_set_commands
+    srx_delete    gen_srx_delete_commands
+The generator cases start from the addresses already ingested (sorted
+integers), which isn't part of their timing or memory. (The SSG and SRX
+constructors aren't timed: they only set up the generators, which run
+when the commands are iterated.)
+Reported for each: addresses per second (the best of --repeat runs),
+commands and bytes generated, and the peak resident memory of the process.
+
+With --save FILE the results are written to FILE as JSON; with --baseline
+FILE they're compared to the ones saved there, and the exit status is 1
+if any case got slower or bigger by more than --max_slowdown or
+--max_growth, or died where it had a result before, so this can guard
+changes to the generators in CI.
+
+NOTE: written for Python 2.x, NOT 3.x
+"""
+
+import argparse
+import array
+import fractions
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import bulk_IP_add_automated as bulk
+
+CASES = ["ingest", "ssg_set", "ssg_unset", "srx_set", "srx_delete"]
+
+# the arguments every generator gets after the addresses
+GENERATOR_ARGS = ("Deny_addr", "benchmark", 256, "V1-Untrust", "255.255.255.255")
+
+GENERATORS = {
+    'ssg_set': bulk.gen_ssg_set_commands,
+    'ssg_unset': bulk.gen_ssg_unset_commands,
+    'srx_set': bulk.gen_srx_set_commands,
+    'srx_delete': bulk.gen_srx_delete_commands,
+}
+
+FIRST = bulk.ip_to_int("10.0.0.0")
+
+# runs shorter than this aren't compared for speed
+MIN_SECONDS = 0.01
+
+def write_input(path, count):
+    """
+    Writes count consecutive addresses to path, one per line, in a shuffled
+    but repeatable order (a stride through them that visits each once), a
+    chunk at a time.
+    """
+    stride = 7919
+    while count and fractions.gcd(stride, count) != 1:
+        stride += 2
+    with open(path, "w") as output:
+        chunk = []
+        for i in xrange(count):
+            chunk.append(bulk.int_to_ip(FIRST + i * stride % count))
+            if len(chunk) == 65536:
+                output.write("\n".join(chunk) + "\n")
+                chunk = []
+        if chunk:
+            output.write("\n".join(chunk) + "\n")
+
+def peak_rss():
+    """
+    Returns the peak resident memory of this process so far, in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    if sys.platform == "darwin":
+        peak /= 1024.0
+    return peak / 1024.0
+
+def run_case(case, size, path, repeat):
+    """
+    Runs one case repeat times and returns its figures. Meant to run in a
+    child process.
+    """
+    if case != "ingest":
+        addresses = bulk.AddressList(array.array("I", xrange(FIRST, FIRST + size)), [])
+    best = None
+    commands = 0
+    size_bytes = 0
+    for _ in range(repeat):
+        started = time.time()
+        if case == "ingest":
+            addresses, rejects = bulk.ingest_addresses(bulk.InputFile(path))
+            commands = len(addresses)
+        else:
+            commands = 0
+            size_bytes = 0
+            for command in GENERATORS[case](addresses, *GENERATOR_ARGS):
+                commands += 1
+                size_bytes += len(command) + 1
+        seconds = time.time() - started
+        if best is None or seconds < best:
+            best = seconds
+    return {
+        'case': case,
+        'size': size,
+        'seconds': best,
+        'rate': size / best if best else 0.0,
+        'commands': commands,
+        'bytes': size_bytes,
+        'rss': peak_rss(),
+    }
+
+def run_in_child(case, size, path, repeat):
+    """
+    Runs one case in a child process and returns its figures, or None if
+    the child died (e.g. out of memory).
+    """
+    results = multiprocessing.Queue()
+
+    def child():
+        results.put(run_case(case, size, path, repeat))
+
+    process = multiprocessing.Process(target=child)
+    process.start()
+    result = None
+    while result is None and (process.is_alive() or not results.empty()):
+        try:
+            result = results.get(timeout=1)
+        except Exception:
+            pass
+    process.join()
+    return result
+
+def compare(results, baseline, max_slowdown, max_growth, died=()):
+    """
+    Returns a line for every result that's slower or bigger than the same
+    case and size in baseline by more than the thresholds, and for every
+    (case, size) in died that baseline has a result for. Cases that took
+    less than MIN_SECONDS aren't compared for speed, as they're too short
+    to time reliably.
+    """
+    before = dict(((x['case'], x['size']), x) for x in baseline)
+    regressions = []
+    for case, size in died:
+        if (case, size) in before:
+            # most likely out of memory, the worst growth there is
+            regressions.append("%s %d: died, had %.0f addresses/s and %.1f MB peak before"
+                               % (case, size, before[(case, size)]['rate'],
+                                  before[(case, size)]['rss']))
+    for result in results:
+        old = before.get((result['case'], result['size']))
+        if old is None:
+            continue
+        timed = min(result['seconds'], old['seconds']) >= MIN_SECONDS
+        if timed and result['rate'] < old['rate'] * (1 - max_slowdown):
+            regressions.append("%s %d: %.0f addresses/s, down from %.0f"
+                               % (result['case'], result['size'], result['rate'], old['rate']))
+        if result['rss'] > old['rss'] * (1 + max_growth):
+            regressions.append("%s %d: %.1f MB peak, up from %.1f"
+                               % (result['case'], result['size'], result['rss'], old['rss']))
+    return regressions
+
+def print_results(results):
+    """
+    Prints one line per case and size.
+    """
+    print ("%-10s %9s %9s %12s %10s %12s %9s"
+           % ("CASE", "SIZE", "SECONDS", "ADDRS/S", "COMMANDS", "BYTES", "PEAK MB"))
+    for result in results:
+        print ("%-10s %9d %9.3f %12.0f %10d %12d %9.1f"
+               % (result['case'], result['size'], result['seconds'], result['rate'],
+                  result['commands'], result['bytes'], result['rss']))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks generating commands and"
+            " ingesting input files of growing sizes.")
+    parser.add_argument('--sizes', metavar='n,n,...', default="1000,10000,100000,1000000",
+            help="The batch sizes (number of addresses). Default: 1000,10000,100000,1000000")
+    parser.add_argument('--cases', metavar='case,...', default=",".join(CASES),
+            help="The cases to run. Default: " + ",".join(CASES))
+    parser.add_argument('-r', '--repeat', metavar='n', default=3, type=int,
+            help="Run each case this many times and keep the fastest. Default: 3")
+    parser.add_argument('--save', metavar='FILE',
+            help="Write the results to FILE as JSON.")
+    parser.add_argument('--baseline', metavar='FILE',
+            help="Compare the results to the ones saved in FILE and exit with 1 if any"
+                 " regressed.")
+    parser.add_argument('--max_slowdown', metavar='fraction', default=0.25, type=float,
+            help="With --baseline, how much lower the addresses per second may be."
+                 " Default: 0.25")
+    parser.add_argument('--max_growth', metavar='fraction', default=0.25, type=float,
+            help="With --baseline, how much higher the peak memory may be. Default: 0.25")
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in args.sizes.split(",")]
+    cases = args.cases.split(",")
+    for case in cases:
+        if case not in CASES:
+            parser.error("unknown case " + case + "; choose from " + ",".join(CASES))
+
+    directory = tempfile.mkdtemp(prefix="generation_benchmark")
+    results = []
+    died = []
+    try:
+        for size in sizes:
+            path = os.path.join(directory, str(size) + ".txt")
+            if "ingest" in cases:
+                write_input(path, size)
+            for case in cases:
+                print "Running " + case + " on " + str(size) + " addresses..."
+                result = run_in_child(case, size, path, args.repeat)
+                if result is None:
+                    print "  " + case + " died on " + str(size) + " addresses"
+                    died.append((case, size))
+                    continue
+                results.append(result)
+            if os.path.exists(path):
+                os.remove(path)
+    finally:
+        shutil.rmtree(directory, True)
+    print
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump({'results': results}, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as input:
+            baseline = json.load(input)['results']
+        regressions = compare(results, baseline, args.max_slowdown, args.max_growth, died)
+        print
+        if regressions:
+            print "Regressions against " + args.baseline + ":"
+            for line in regressions:
+                print "  " + line
+            sys.exit(1)
+        print "No regressions against " + args.baseline
+
+if __name__ == '__main__':
+    main()